@@ -0,0 +1,173 @@
+import datetime
+import smtplib
+import socket
+import sqlite3
+import threading
+
+import log
+
+
+class AlertSender(object):
+    """Emails the alerts queued with db.DB.queue_alert, on a background thread.
+
+    Queuing an alert is a local database write, so neither the control loop
+    nor its shutdown path ever waits on the mail server; call notify() after
+    queuing one. Everything due goes out in one message. If that fails, the
+    alerts are tried again retry_delay seconds later, doubling up to
+    max_retry_delay. Sent alerts are deleted after retention seconds.
+
+    The thread shares the caller's db.DB (and so gets a connection of its
+    own). An alert can be sent twice if the database is too busy to mark it
+    sent, but is never lost.
+    """
+    # Seconds to wait on the mail server
+    timeout = 20
+    retry_delay = 60
+    max_retry_delay = 60*60
+    retention = 7*24*60*60
+    # Longest to sleep without checking the outbox, in case another process
+    # queued something
+    interval = 5*60
+
+    def __init__(self, database, logger, host, port, sender, recipient,
+                 username=None, password=None, starttls=True):
+        self.database = database
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipient = recipient
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+
+        self.sent = 0
+        self.failures = 0
+
+        self.wake = threading.Event()
+        # self.lock guards stopping and delivering, so that stop() knows
+        # whether the thread could be waiting on the mail server
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.delivering = False
+        # Whether to make one last delivery once stopping
+        self.drain = False
+        self.thread = threading.Thread(target=self.run, name="alerts")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def notify(self):
+        """Tell the thread an alert was queued. Never blocks."""
+        self.wake.set()
+
+    def stop(self, timeout=None):
+        """Stop the thread without waiting on the mail server: if it is in
+        the middle of a delivery, it is left to finish on its own. Given a
+        timeout, it instead makes one last delivery of anything due, which
+        is waited on for at most timeout seconds. Returns False if the
+        thread is still going; whatever it didn't get sent stays queued for
+        the next start."""
+        with self.lock:
+            self.drain = timeout is not None
+            self.stopping = True
+            delivering = self.delivering
+        self.wake.set()
+        if not self.thread.is_alive():
+            return True
+        if timeout is not None:
+            self.thread.join(timeout)
+        elif not delivering:
+            # It is only waiting for work, and now exits right away
+            self.thread.join()
+        return not self.thread.is_alive()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.stopping:
+                    break
+                self.delivering = True
+            try:
+                self.deliver()
+            finally:
+                self.delivering = False
+            self.wake.wait(self.wait_time())
+            self.wake.clear()
+        if self.drain:
+            self.deliver()
+
+    def wait_time(self):
+        try:
+            due = self.database.get_next_alert_time()
+        except sqlite3.Error:
+            return self.retry_delay
+        if due is None:
+            return self.interval
+        return max(0, min(self.interval, due - self.database.clock.time()))
+
+    def deliver(self):
+        try:
+            alerts = self.database.get_due_alerts()
+            if not alerts:
+                return
+            ids = [alert[0] for alert in alerts]
+            (subject, body) = self.compose(alerts)
+            try:
+                self.send(subject, body)
+            except (smtplib.SMTPException, socket.error), e:
+                self.failures += 1
+                delay = min(self.retry_delay * 2**max(
+                    alert[6] for alert in alerts), self.max_retry_delay)
+                self.logger.write_log(
+                    "### Couldn't email %d alert(s) (%s); trying again in %d "
+                    "seconds." % (len(alerts), e, delay), log.WARNING)
+                self.database.defer_alerts(ids, delay)
+                return
+            self.sent += 1
+            self.database.mark_alerts_sent(ids)
+            self.database.delete_sent_alerts(
+                    self.database.clock.time() - self.retention)
+        except sqlite3.Error, e:
+            self.logger.write_log("### Couldn't read alert outbox: %s" % e,
+                    log.WARNING)
+
+    def compose(self, alerts):
+        """One message for the given get_due_alerts rows."""
+        def when(timestamp):
+            return datetime.datetime.fromtimestamp(timestamp).strftime(
+                    "%Y-%m-%d %H:%M:%S")
+        sections = []
+        for (_, subject, body, count, first_seen, last_seen, _) in alerts:
+            if count > 1:
+                heading = "%s (%d times, %s to %s)" % (subject, count,
+                        when(first_seen), when(last_seen))
+            else:
+                heading = "%s (%s)" % (subject, when(first_seen))
+            sections.append("%s\n%s\n%s\n" % (heading, "=" * len(heading),
+                    body))
+        if len(alerts) == 1:
+            subject = alerts[0][1]
+            if alerts[0][3] > 1:
+                subject += " (%d times)" % alerts[0][3]
+        else:
+            subject = "pi-timer: %d alerts" % len(alerts)
+        return (subject, "\n".join(sections))
+
+    def send(self, subject, body):
+        header  = 'From: %s\n' % self.sender
+        header += 'To: %s\n' % self.recipient
+        header += 'Subject: %s\n\n' % subject
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.username:
+                server.login(self.username, self.password)
+            server.sendmail(self.sender, self.recipient, header + body)
+        finally:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, socket.error):
+                server.close()
@@ -0,0 +1,1005 @@
+#!/usr/bin/python
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import asyncore
+import collections
+import datetime
+import httplib
+import json
+import os
+import re
+import shutil
+import signal
+import smtpd
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+import alerts
+import db
+import gcal
+import report
+import schedules
+
+DAEMON = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "pi-timer-daemon.py")
+# As in pi-timer-daemon.py: the longest the daemon waits on another writer
+DB_BUSY_TIMEOUT = 2
+
+
+def check(failures):
+    """Exit non-zero, listing failures, if there are any."""
+    if failures:
+        print
+        for failure in failures:
+            print "FAILED: %s" % failure
+        sys.exit(1)
+
+
+def populate(filename, devices, rows):
+    """Create an unversioned (pre-migration) database with synthetic data."""
+    conn = sqlite3.connect(filename)
+    for statement in db.MIGRATIONS[0]:
+        conn.execute(statement)
+    conn.execute("PRAGMA user_version = 1")
+
+    now = int(time.time())
+    # Spread on/off edges evenly over the past, newest last
+    spacing = 60
+    history = []
+    for i in xrange(rows):
+        timestamp = now - (rows - i) * spacing
+        history.append((timestamp, i % devices, (i / devices) % 2))
+    conn.executemany("INSERT INTO device_history VALUES (?, ?, ?)", history)
+
+    schedule = []
+    for device in xrange(devices):
+        for day in xrange(30):
+            start_time = now - day * 24*60*60
+            schedule.append((start_time, device, start_time, 600, 60))
+    conn.executemany(
+        "INSERT INTO device_schedule VALUES (?, ?, ?, ?, ?)", schedule)
+    conn.commit()
+    conn.close()
+
+
+def time_polls(database, devices, polls):
+    """Average latency of the queries the daemon runs for one device poll."""
+    window = 600 + 60*60
+    start = time.time()
+    for i in xrange(polls):
+        device = i % devices
+        database.get_device_history(device, int(time.time()) - window)
+        database.get_device_schedule(device)
+    return (time.time() - start) / polls
+
+
+def bench_queries(args):
+    print "%10s %16s %16s" % ("rows", "unindexed (ms)", "migrated (ms)")
+    for rows in args.rows:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "db.sqlite")
+            populate(filename, args.devices, rows)
+
+            database = db.DB(filename, None)
+            after = time_polls(database, args.devices, args.polls)
+
+            # Drop every index on the tables a poll reads (migrations 2 and
+            # 8 add them) to time the old access paths with the current
+            # queries
+            for (name,) in database.conn.execute(
+                    '''SELECT name FROM sqlite_master
+                       WHERE type = 'index' AND sql IS NOT NULL AND
+                             tbl_name IN ('device_history', 'device_schedule')
+                    ''').fetchall():
+                database.conn.execute("DROP INDEX %s" % name)
+            before = time_polls(database, args.devices, args.polls)
+            database.close()
+
+            print "%10d %16.3f %16.3f" % (rows, before * 1000, after * 1000)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def write_history(filename, durability, events):
+    """Log events through db.DB; returns (seconds, commits)."""
+    database = db.DB(filename, None, durability)
+    start = time.time()
+    for i in xrange(events):
+        database.log_device_enabled(i % 8, i % 2)
+    database.close()
+    return (time.time() - start, database.commits)
+
+
+def count_fsyncs(durability, events):
+    """Re-run the writer under strace and count its sync calls."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        output = subprocess.check_output([
+            "strace", "-f", "-c", "-e", "trace=fsync,fdatasync",
+            sys.executable, os.path.abspath(__file__), "history-writer",
+            "--durability", durability, "--events", str(events),
+            "--filename", os.path.join(tmpdir, "db.sqlite")],
+            stderr=subprocess.STDOUT)
+    finally:
+        shutil.rmtree(tmpdir)
+    return sum(int(match) for match in
+            re.findall(r"^\s*[\d.]+\s+[\d.]+\s+\d+\s+(\d+)\s+(?:\d+\s+)?f(?:data)?sync$",
+                output, re.M))
+
+
+def bench_history(args):
+    have_strace = any(
+        os.access(os.path.join(path, "strace"), os.X_OK)
+        for path in os.environ.get("PATH", "").split(os.pathsep))
+
+    print "%10s %14s %10s %10s" % ("durability", "events/sec", "commits", "fsyncs")
+    for durability in (db.DURABILITY_STRICT, db.DURABILITY_BATCHED):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            (seconds, commits) = write_history(
+                    os.path.join(tmpdir, "db.sqlite"), durability, args.events)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        fsyncs = "n/a"
+        if have_strace:
+            fsyncs = str(count_fsyncs(durability, args.events))
+        print "%10s %14.0f %10d %10s" % (
+                durability, args.events / seconds, commits, fsyncs)
+    if not have_strace:
+        print "Install strace to count fsync calls."
+
+
+def populate_schedules(filename, devices, days, group_size):
+    """Devices with a daily calendar run each, a few per group.
+
+    Runs in a group start 15 minutes apart but last 10 to 20 minutes, so
+    some of them contend for the group. Returns {device: [(start, duration)]}
+    with start in seconds since the epoch.
+    """
+    database = db.DB(filename, None)
+    first = (datetime.datetime.now() + datetime.timedelta(hours=1)).replace(
+            minute=0, second=0, microsecond=0)
+    runs = {}
+    upserts = []
+    for device in xrange(devices):
+        database.add_device(device, device / group_size, "sprinkler",
+                "Zone %d" % device, device)
+        offset = datetime.timedelta(minutes=15 * (device % group_size) +
+                (device / group_size) % 60)
+        duration = 600 + 60 * (device % 11)
+        for day in xrange(days):
+            start_time = first + offset + datetime.timedelta(day)
+            upserts.append(("sim-%d-%d" % (device, day), None, device,
+                start_time, duration))
+            runs.setdefault(device, []).append(
+                (schedules.to_seconds(start_time), duration))
+    database.update_calendar_schedule(upserts, [])
+    database.close()
+    return runs
+
+
+def run_accuracy(history, runs):
+    """Per-run (seconds short of the scheduled duration, start delay).
+
+    history is a device's (timestamp, enabled) rows, oldest first.
+    """
+    intervals = []
+    on_since = None
+    for (timestamp, enabled) in history:
+        if enabled and on_since is None:
+            on_since = timestamp
+        elif not enabled and on_since is not None:
+            intervals.append((on_since, timestamp))
+            on_since = None
+
+    results = []
+    for (start, duration) in runs:
+        end = start + duration + schedules.WINDOW_GRACE
+        overlapping = [(max(on, start), min(off, end))
+                for (on, off) in intervals if on < end and off > start]
+        seconds_on = sum(off - on for (on, off) in overlapping)
+        delay = overlapping[0][0] - start if overlapping else end - start
+        results.append((abs(duration - seconds_on), delay))
+    return results
+
+
+def bench_daemon(args):
+    print "%8s %8s %10s %10s %10s %8s %10s %10s %10s" % (
+        "devices", "wall (s)", "iter (us)", "p99 (us)", "sql/poll",
+        "rows/day", "db (KB)", "err (s)", "delay (s)")
+    for devices in args.sim_devices:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "db.sqlite")
+            stats_filename = os.path.join(tmpdir, "stats.json")
+            runs = populate_schedules(filename, devices, args.days,
+                    args.group_size)
+            subprocess.check_call([sys.executable, DAEMON,
+                "--db", filename, "--log", os.path.join(tmpdir, "log.txt"),
+                "--simulate", str(args.days), "--stats", stats_filename])
+            stats = json.load(open(stats_filename))
+
+            database = db.DB(filename, None)
+            rows = 0
+            results = []
+            for device in xrange(devices):
+                history = database.get_device_history(device, 0)
+                rows += len(history)
+                results.extend(run_accuracy(history, runs[device]))
+            database.close()
+            size = sum(os.path.getsize(os.path.join(tmpdir, name))
+                    for name in os.listdir(tmpdir) if name.startswith("db."))
+        finally:
+            shutil.rmtree(tmpdir)
+
+        print "%8d %8.1f %10.1f %10.1f %10.2f %8.1f %10d %10.1f %10.1f" % (
+            devices, stats["wall_seconds"], stats["latency_mean"] * 1e6,
+            stats["latency_p99"] * 1e6, stats["statements_per_poll"],
+            float(rows) / args.days, size / 1024,
+            sum(result[0] for result in results) / len(results),
+            sum(result[1] for result in results) / len(results))
+
+
+def stress_reader(args):
+    """Repeat the old dashboard's full-history reads for args.seconds.
+
+    Readers don't wait on locks at all, so any blocking shows up as an
+    error. Prints {"queries": n, "errors": n} as JSON.
+    """
+    conn = sqlite3.connect(args.filename, timeout=0)
+    queries = errors = 0
+    end = time.time() + args.seconds
+    while time.time() < end:
+        for device in xrange(args.devices):
+            try:
+                conn.execute(
+                    '''SELECT timestamp, enabled FROM device_history
+                       WHERE device = ? ORDER BY timestamp''',
+                    (device,)).fetchall()
+                queries += 1
+            except sqlite3.OperationalError:
+                errors += 1
+    print json.dumps({"queries": queries, "errors": errors})
+
+
+def stress_writer(args):
+    """Rewrite a calendar schedule every 50ms for args.seconds, the way
+    calendar syncs and timer.py write alongside the daemon."""
+    database = db.DB(args.filename, None)
+    start_time = datetime.datetime.now()
+    end = time.time() + args.seconds
+    while time.time() < end:
+        database.update_calendar_schedule(
+            [("stress", None, 0, start_time, 600)], [])
+        time.sleep(0.05)
+    database.close()
+
+
+def bench_stress(args):
+    """Log history the way the daemon does while other processes read it
+    and write schedules.
+
+    Fails if logging a row ever took longer than the daemon's
+    DB_BUSY_TIMEOUT, if a row that had to be buffered ("deferred") never
+    made it to the table, or if another process failed.
+    """
+    print "%8s %10s %8s %8s %8s %9s %10s %8s %8s" % (
+        "readers", "events/sec", "p50 (ms)", "p99 (ms)", "max (ms)",
+        "deferred", "reads/sec", "blocked", "wal (KB)")
+    failures = []
+    for readers in args.readers:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "db.sqlite")
+            populate(filename, args.devices, args.history_rows)
+            database = db.DB(filename, None, db.DURABILITY_STRICT,
+                    busy_timeout=DB_BUSY_TIMEOUT)
+            initial_rows = database.count_history()
+
+            command = [sys.executable, os.path.abspath(__file__),
+                    "--filename", filename, "--seconds", str(args.seconds),
+                    "--devices", str(args.devices)]
+            processes = [subprocess.Popen(command + ["stress-reader"],
+                    stdout=subprocess.PIPE) for i in xrange(readers)]
+            processes.append(subprocess.Popen(command + ["stress-writer"]))
+
+            # Log events as fast as the daemon possibly could, one commit
+            # each, while the others run
+            latencies = []
+            deferred = 0
+            end = time.time() + args.seconds
+            while time.time() < end:
+                start = time.time()
+                database.log_device_enabled(len(latencies) % args.devices,
+                        len(latencies) % 2)
+                latencies.append(time.time() - start)
+                if database.pending_history:
+                    deferred += 1
+            # Readers can hold back checkpoints, so see how far the log grew
+            wal = os.path.getsize(filename + "-wal")
+
+            results = [json.loads(process.communicate()[0] or "null")
+                    for process in processes]
+            database.close()
+            reads = sum(result["queries"] for result in results if result)
+            blocked = sum(result["errors"] for result in results if result)
+
+            database = db.DB(filename, None)
+            lost = initial_rows + len(latencies) - database.count_history()
+            database.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        latencies.sort()
+        print "%8d %10.0f %8.2f %8.2f %8.1f %9d %10.0f %8d %8d" % (
+            readers, len(latencies) / args.seconds,
+            latencies[len(latencies) / 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            latencies[-1] * 1000, deferred, reads / args.seconds, blocked,
+            wal / 1024)
+        if latencies[-1] > DB_BUSY_TIMEOUT:
+            failures.append("%d readers: a write blocked for %.1f seconds" % (
+                readers, latencies[-1]))
+        if lost:
+            failures.append("%d readers: %d history rows never written" % (
+                readers, lost))
+        failed = sum(1 for process in processes if process.returncode)
+        if failed:
+            failures.append("%d readers: %d other processes failed" % (
+                readers, failed))
+    check(failures)
+
+
+def bench_threads(args):
+    """Share one db.DB between threads the way the daemon does.
+
+    The main thread logs history as fast as it can, one commit per event,
+    while readers query it like the data service and another thread
+    rewrites a calendar schedule every 50ms. Afterwards every logged event
+    must be in the table exactly once and the schedule must hold the last
+    write; "errors" counts exceptions raised in any thread.
+    """
+    print "%8s %10s %8s %10s %8s %8s %8s %6s" % (
+        "readers", "events/sec", "p99 (ms)", "reads/sec", "syncs",
+        "errors", "lost", "conns")
+    failures = []
+    for readers in args.readers:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "db.sqlite")
+            populate(filename, args.devices, args.history_rows)
+            database = db.DB(filename, None, db.DURABILITY_STRICT)
+            initial_rows = database.count_history()
+            counts = collections.Counter()
+            stop = threading.Event()
+
+            def read():
+                cursor = database.get_last_history_id()
+                while not stop.is_set():
+                    try:
+                        device = counts["reads"] % args.devices
+                        now = int(time.time())
+                        database.get_device_history(device, now - 3600)
+                        database.get_history_window(now - 24*60*60, now)
+                        rows = database.get_history_since(cursor)
+                        if rows:
+                            cursor = rows[-1][0]
+                        counts["reads"] += 3
+                    except Exception:
+                        counts["errors"] += 1
+
+            def sync():
+                start_time = datetime.datetime.now()
+                while not stop.is_set():
+                    try:
+                        counts["syncs"] += 1
+                        database.update_calendar_schedule([("threads", None,
+                            args.devices, start_time, counts["syncs"])], [])
+                    except Exception:
+                        counts["errors"] += 1
+                    time.sleep(0.05)
+
+            threads = [threading.Thread(target=read) for i in xrange(readers)]
+            threads.append(threading.Thread(target=sync))
+            for thread in threads:
+                thread.start()
+
+            latencies = []
+            end = time.time() + args.seconds
+            while time.time() < end:
+                start = time.time()
+                try:
+                    database.log_device_enabled(
+                            len(latencies) % args.devices, len(latencies) % 2)
+                except Exception:
+                    counts["errors"] += 1
+                latencies.append(time.time() - start)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            connections = len(database.connections)
+            database.close()
+
+            database = db.DB(filename, None)
+            lost = initial_rows + len(latencies) - database.count_history()
+            # A device without populate()'s schedule rows
+            schedule = database.get_calendar_schedules().get(args.devices, [])
+            if [item["duration"] for item in schedule] != [counts["syncs"]]:
+                counts["errors"] += 1
+            database.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        latencies.sort()
+        print "%8d %10.0f %8.2f %10.0f %8d %8d %8d %6d" % (
+            readers, len(latencies) / args.seconds,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            counts["reads"] / args.seconds, counts["syncs"], counts["errors"],
+            lost, connections)
+        if counts["errors"]:
+            failures.append("%d readers: %d errors or lost schedule writes" % (
+                readers, counts["errors"]))
+        if lost:
+            failures.append("%d readers: %d history rows lost" % (
+                readers, lost))
+    check(failures)
+
+
+def bench_nodes(args):
+    """Run one daemon per node against a shared database, in real time.
+
+    args.devices devices are spread over args.nodes nodes, all in one group
+    that lets args.capacity run at once, and all due to run for
+    args.run_seconds right away (which must be over the calendar
+    scheduler's one minute minimum). Afterwards the history shows whether the
+    group was ever over capacity across nodes, whether every run finished,
+    and how long it all took against the ideal. Fails on either of the
+    first two.
+    """
+    print "%6s %8s %9s %7s %9s %10s %10s" % (
+        "nodes", "devices", "capacity", "max on", "complete", "span (s)",
+        "ideal (s)")
+    tmpdir = tempfile.mkdtemp()
+    processes = []
+    try:
+        filename = os.path.join(tmpdir, "db.sqlite")
+        database = db.DB(filename, None)
+        database.set_group_capacity(0, args.capacity)
+        start_time = datetime.datetime.now()
+        upserts = []
+        for device in xrange(args.devices):
+            database.add_device(device, 0, "sprinkler", "Zone %d" % device,
+                    device, "node%d" % (device % args.nodes))
+            upserts.append(("nodes-%d" % device, None, device, start_time,
+                    args.run_seconds))
+        database.update_calendar_schedule(upserts, [])
+
+        for node in xrange(args.nodes):
+            processes.append(subprocess.Popen([sys.executable, DAEMON,
+                "--db", filename,
+                "--log", os.path.join(tmpdir, "node%d.log" % node),
+                "--node", "node%d" % node, "--no-calendar-sync",
+                "--metrics-port", "0", "--data-port", "0"]))
+
+        # Done once nobody holds or waits for a slot any more
+        started = time.time()
+        ideal = -(-args.devices // args.capacity) * args.run_seconds
+        while time.time() - started < ideal * 3 + 60:
+            time.sleep(1)
+            leases = database.conn.execute(
+                    "SELECT COUNT(*) FROM group_leases").fetchone()[0]
+            if leases == 0 and time.time() - started > args.run_seconds + 10:
+                break
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+        for process in processes:
+            process.wait()
+
+    try:
+        edges = []
+        complete = 0
+        for device in xrange(args.devices):
+            history = database.get_device_history(device, 0)
+            (days, on_since) = db.summarize_days(history)
+            if sum(day[0] for day in days.values()) >= args.run_seconds:
+                complete += 1
+            edges.extend((timestamp, enabled) for (timestamp, enabled)
+                    in history)
+        database.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # Offs sort before ons in the same second
+    edges.sort()
+    on = most = 0
+    for (timestamp, enabled) in edges:
+        on += 1 if enabled else -1
+        most = max(most, on)
+    span = edges[-1][0] - edges[0][0] if edges else 0
+    print "%6d %8d %9d %7d %9d %10d %10d" % (
+        args.nodes, args.devices, args.capacity, most, complete, span, ideal)
+    failures = []
+    if most > args.capacity:
+        failures.append("%d devices were on at once; capacity is %d" % (
+            most, args.capacity))
+    if complete < args.devices:
+        failures.append("%d of %d runs didn't finish" % (
+            args.devices - complete, args.devices))
+    check(failures)
+
+
+def report_totals(database, devices, from_timestamp, now):
+    """Runtime and runs in report.build_report from from_timestamp, and the
+    device-days where they differ from DB.get_device_daily's."""
+    rows = list(report.build_report(database, from_timestamp, now, now=now))
+    from_timestamp = report.period_bounds(from_timestamp, now, "day")[0]
+    mismatches = 0
+    for device in xrange(devices):
+        daily = dict((datetime.date.fromtimestamp(row[0]).isoformat(), row[1:3])
+                for row in database.get_device_daily(device, from_timestamp, now))
+        for row in rows:
+            if row["device"] == device and (row["runtime"], row["runs"]) != \
+                    tuple(daily.get(row["period"], (0, 0))):
+                mismatches += 1
+    return (sum(row["runtime"] for row in rows),
+            sum(row["runs"] for row in rows), mismatches)
+
+
+def bench_report(args):
+    """Report over history with a run across every midnight, before and
+    after compacting all but the last half of it.
+
+    Each report starts either before all history or a few days into the
+    part that gets compacted, where the last rollup before it ends with the
+    devices on. Totals must stay the same after compaction, and every
+    device-day must agree with DB.get_device_daily.
+    """
+    print "%10s %8s %12s %8s %10s %10s" % (
+        "history", "from", "runtime", "runs", "mismatches", "time (ms)")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        database = db.DB(os.path.join(tmpdir, "db.sqlite"), None)
+        today = datetime.datetime.combine(datetime.date.today(),
+                datetime.time())
+        now = time.time()
+        history = []
+        for day in xrange(args.days, 0, -1):
+            midnight = today - datetime.timedelta(day)
+            for device in xrange(args.devices):
+                events = [
+                    (datetime.timedelta(hours=6, minutes=10 * device), 1),
+                    (datetime.timedelta(hours=6, minutes=10 * device + 10), 0),
+                    (datetime.timedelta(hours=23, minutes=50), 1),
+                    (datetime.timedelta(days=1, minutes=10), 0),
+                ]
+                for (offset, enabled) in events:
+                    history.append((int(time.mktime(
+                        (midnight + offset).timetuple())), device, enabled))
+        with database.transaction() as c:
+            c.executemany(db.INSERT_HISTORY, sorted(history))
+        for device in xrange(args.devices):
+            database.add_device(device, device, "sprinkler",
+                    "Zone %d" % device, device)
+
+        retention = max(1, args.days / 2)
+        starts = [("all", now - (args.days + 1) * 24*60*60),
+                  ("compacted", now - (retention + 3) * 24*60*60)]
+        for stage in ("raw", "compacted"):
+            if stage == "compacted":
+                while database.compact_history(retention):
+                    pass
+            for (name, from_timestamp) in starts:
+                start = time.time()
+                (runtime, runs, mismatches) = report_totals(database,
+                        args.devices, from_timestamp, now)
+                print "%10s %8s %12d %8d %10d %10.1f" % (stage, name, runtime,
+                        runs, mismatches, (time.time() - start) * 1000)
+        database.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class NullLogger(object):
+    level = 0
+
+    def write_log(self, msg, level=None):
+        pass
+
+
+class StandInSMTPServer(smtpd.SMTPServer):
+    """Keeps the messages it receives, on a thread of its own."""
+    def __init__(self, port):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", port), None)
+        self.messages = []
+        self.thread = threading.Thread(target=asyncore.loop,
+                kwargs={"timeout": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(data)
+
+    def stop(self):
+        self.close()
+        self.thread.join()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def bench_alerts(args):
+    """Queue alerts under a few keys while the mail server is down, then
+    bring up a local stand-in and let the sender drain the outbox.
+
+    Afterwards the counts of the alerts marked sent must add up to the
+    number queued ("lost" otherwise), in far fewer emails. Then a server
+    that accepts connections but never answers shows that queuing and
+    stopping the sender don't wait on it.
+    """
+    print "%8s %8s %10s %10s %8s %8s %8s %8s %10s" % (
+        "events", "keys", "p99 (ms)", "max (ms)", "emails", "failures",
+        "unsent", "lost", "stop (ms)")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        database = db.DB(os.path.join(tmpdir, "db.sqlite"), None)
+        logger = NullLogger()
+        port = free_port()
+        sender = alerts.AlertSender(database, logger, "127.0.0.1", port,
+                "pi-timer@localhost", "owner@localhost", starttls=False)
+        sender.retry_delay = 0.1
+        sender.max_retry_delay = 0.5
+        sender.start()
+
+        keys = 5
+        latencies = []
+        def queue(count):
+            for i in xrange(count):
+                start = time.time()
+                database.queue_alert("error %d" % (i % keys), "Error",
+                        "Event %d" % i)
+                sender.notify()
+                latencies.append(time.time() - start)
+
+        queue(args.events / 2)
+        time.sleep(args.seconds / 2)
+        server = StandInSMTPServer(port)
+        queue(args.events - args.events / 2)
+        deadline = time.time() + args.seconds
+        while database.get_next_alert_time() is not None and \
+                time.time() < deadline:
+            time.sleep(0.05)
+        sender.stop(args.seconds)
+        server.stop()
+
+        c = database.conn.cursor()
+        (sent, unsent) = c.execute(
+            '''SELECT TOTAL(CASE WHEN sent IS NOT NULL THEN count END),
+                      COUNT(CASE WHEN sent IS NULL THEN 1 END)
+               FROM alerts''').fetchone()
+        lost = args.events - int(sent)
+
+        # A server that accepts connections and never answers
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        stuck = alerts.AlertSender(database, logger, "127.0.0.1",
+                listener.getsockname()[1], "pi-timer@localhost",
+                "owner@localhost", starttls=False)
+        stuck.timeout = args.seconds
+        stuck.start()
+        # A key not sent yet, so it is due and the sender gets stuck on it
+        database.queue_alert("unanswered", "Error", "Never sent")
+        stuck.notify()
+        time.sleep(0.1)
+        queue(100)
+        start = time.time()
+        stuck.stop()
+        stop_seconds = time.time() - start
+        listener.close()
+        database.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    latencies.sort()
+    print "%8d %8d %10.2f %10.2f %8d %8d %8d %8d %10.2f" % (
+        args.events, keys, latencies[int(len(latencies) * 0.99)] * 1000,
+        latencies[-1] * 1000, len(server.messages), sender.failures, unsent,
+        lost, stop_seconds * 1000)
+
+
+class StandInCalendar(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a Google Calendar event list on a thread of its own.
+
+    Lists are paged, incremental with sync tokens and ETags, and answer 304
+    when nothing changed, like the real API. Each name in faults is applied
+    to one request, in order: "stall" waits stall seconds and hangs up,
+    "5xx" answers 503, "drop" hangs up without answering and "410" expires
+    the sync token.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, events, devices, stall):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                StandInCalendarHandler)
+        self.port = self.server_address[1]
+        self.stall = stall
+        self.faults = []
+        self.requests = 0
+        self.version = 1
+        # Spread over the sync window, so every event is kept
+        start = datetime.datetime.now().replace(microsecond=0)
+        spacing = 6*24*60*60 / max(events, 1)
+        self.events = []
+        for i in xrange(events):
+            self.events.append({"id": "event%d" % i, "version": 1,
+                "start": start + datetime.timedelta(seconds=i * spacing),
+                "device": i % devices})
+        self.thread = threading.Thread(target=self.serve_forever,
+                kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def change(self, count):
+        """Edit the first count events."""
+        self.version += 1
+        for event in self.events[:count]:
+            event["version"] = self.version
+
+    def etag(self):
+        return '"%d"' % self.version
+
+    def list_events(self, params, etag):
+        """(status, body) for an event list request."""
+        items = self.events
+        if "syncToken" in params:
+            if etag == self.etag():
+                return (304, None)
+            since = int(params["syncToken"])
+            items = [event for event in items if event["version"] > since]
+        offset = int(params.get("pageToken", 0))
+        end = offset + int(params.get("maxResults", 250))
+        body = {"items": [{
+            "id": event["id"],
+            "etag": '"%s-%d"' % (event["id"], event["version"]),
+            "status": "confirmed",
+            "summary": "device:%d" % event["device"],
+            "start": {"dateTime":
+                event["start"].isoformat("T") + "+00:00"},
+            "end": {"dateTime": (event["start"] +
+                datetime.timedelta(minutes=10)).isoformat("T") + "+00:00"},
+        } for event in items[offset:end]]}
+        if end < len(items):
+            body["nextPageToken"] = str(end)
+        else:
+            body["nextSyncToken"] = str(self.version)
+        return (200, body)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInCalendarHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        fault = server.faults.pop(0) if server.faults else None
+        if fault in ("stall", "drop"):
+            if fault == "stall":
+                time.sleep(server.stall)
+            self.close_connection = True
+            return
+        if fault == "5xx":
+            (status, body) = (503, None)
+        elif fault == "410":
+            (status, body) = (410, {"error": {"code": 410}})
+        else:
+            (status, body) = server.list_events(dict(urlparse.parse_qsl(
+                urlparse.urlparse(self.path).query)),
+                self.headers.getheader("If-None-Match"))
+        data = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        self.send_header("ETag", server.etag())
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TimedSync(gcal.CalendarSync):
+    """Records how each sync attempt ended and signals finished."""
+    def __init__(self, *args, **kwargs):
+        gcal.CalendarSync.__init__(self, *args, **kwargs)
+        self.finished = threading.Event()
+        self.outcome = None
+
+    def update(self, database):
+        self.outcome = "failed"
+        try:
+            schedules = gcal.CalendarSync.update(self, database)
+            self.outcome = "unchanged" if schedules is None else "published"
+            return schedules
+        except gcal.SyncError:
+            self.outcome = "gave up"
+            raise
+        finally:
+            self.finished.set()
+
+
+def calendar_sync(database, server, cls=gcal.CalendarSync, **kwargs):
+    """A CalendarSync that talks to server, with short timeouts."""
+    sync = cls(database, NullLogger(), interval=0, **kwargs)
+    sync.connection_class = lambda host, timeout: httplib.HTTPConnection(
+            "127.0.0.1", server.port, timeout=timeout)
+    sync.timeout = 0.5
+    sync.backoff_delay = 0.1
+    return sync
+
+
+def bench_calendar(args):
+    """Sync from a local stand-in for Google Calendar.
+
+    First, on the sync thread, through each kind of failure: the time the
+    sync takes must match the timeout and backoff ("expected"), and a
+    control loop ticking every 10ms on the main thread must stay on time.
+    Then full and incremental syncs of growing calendars: full syncs grow
+    with the calendar, while an incremental sync with nothing changed, or
+    one change, must take the same requests and bytes at any size.
+    """
+    tick = 0.01
+    tmpdir = tempfile.mkdtemp()
+    try:
+        database = db.DB(os.path.join(tmpdir, "db.sqlite"), None)
+        database.set_tokens("token", "refresh")
+        server = StandInCalendar(max(args.calendar_events), args.devices, 1.0)
+        sync = calendar_sync(database, server, TimedSync,
+                publish=lambda schedules: None, fail=lambda error: None)
+        sync.start()
+        retries = sync.retries + 1
+        backoff = sync.backoff_delay * (2**sync.retries - 1)
+        print "%10s %8s %8s %12s %10s %10s %10s" % (
+            "fault", "requests", "sync (s)", "expected (s)", "outcome",
+            "p99 (ms)", "max (ms)")
+        for (fault, faults, expected) in [
+                ("none", [], None),
+                ("unchanged", [], None),
+                ("stall", ["stall"] * retries,
+                    retries * sync.timeout + backoff),
+                ("5xx", ["5xx"] * retries, backoff),
+                ("drop", ["drop"] * retries, backoff),
+                ("5xx, then ok", ["5xx"] * 2, sync.backoff_delay * 3),
+                ("410", ["410"], None)]:
+            server.faults = faults
+            server.requests = 0
+            sync.finished.clear()
+            lateness = []
+            start = time.time()
+            sync.request_sync()
+            while not sync.finished.is_set() and sync.thread.is_alive():
+                before = time.time()
+                time.sleep(tick)
+                lateness.append(time.time() - before - tick)
+            elapsed = time.time() - start
+            lateness.sort()
+            print "%10s %8d %8.2f %12s %10s %10.2f %10.2f" % (
+                fault, server.requests, elapsed,
+                "%.2f" % expected if expected is not None else "-",
+                sync.outcome,
+                lateness[int(len(lateness) * 0.99)] * 1000 if lateness else 0,
+                lateness[-1] * 1000 if lateness else 0)
+        sync.stop()
+        sync.thread.join()
+        server.stop()
+        database.close()
+
+        print
+        print "%8s %8s %10s %8s %10s %8s %10s %8s" % (
+            "events", "full", "full (KB)", "full (s)", "unchanged", "bytes",
+            "1 change", "bytes")
+        for events in args.calendar_events:
+            database = db.DB(os.path.join(tmpdir, "%d.sqlite" % events), None)
+            database.set_tokens("token", "refresh")
+            server = StandInCalendar(events, args.devices, 1.0)
+            sync = calendar_sync(database, server, publish=None, fail=None)
+            start = time.time()
+            sync.update(database)
+            full = (sync.round_trips, sync.bytes_received,
+                    time.time() - start)
+            sync.update(database)
+            unchanged = (sync.round_trips, sync.bytes_received)
+            server.change(1)
+            sync.update(database)
+            changed = (sync.round_trips, sync.bytes_received)
+            sync.close_connection(sync.api_host)
+            server.stop()
+            database.close()
+            print "%8d %8d %10.1f %8.2f %10d %8d %10d %8d" % (
+                events, full[0], full[1] / 1024.0, full[2], unchanged[0],
+                unchanged[1], changed[0], changed[1])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+parser = argparse.ArgumentParser(description='Benchmark pi-timer components')
+parser.add_argument('benchmark',
+        choices=['queries', 'history', 'history-writer', 'daemon', 'stress',
+                 'stress-reader', 'stress-writer', 'threads', 'nodes',
+                 'alerts', 'report', 'calendar'])
+parser.add_argument('--devices', type=int, default=8)
+parser.add_argument('--polls', type=int, default=200)
+parser.add_argument('--rows', type=int, nargs='+',
+        default=[10000, 100000, 1000000])
+parser.add_argument('--events', type=int, default=5000)
+parser.add_argument('--durability', default=db.DURABILITY_STRICT)
+parser.add_argument('--filename')
+parser.add_argument('--sim-devices', type=int, nargs='+',
+        default=[1, 10, 100, 1000])
+parser.add_argument('--days', type=int, default=14)
+parser.add_argument('--group-size', type=int, default=4)
+parser.add_argument('--readers', type=int, nargs='+', default=[0, 1, 4])
+parser.add_argument('--seconds', type=float, default=5)
+parser.add_argument('--history-rows', type=int, default=100000)
+parser.add_argument('--nodes', type=int, default=3)
+parser.add_argument('--capacity', type=int, default=2)
+parser.add_argument('--run-seconds', type=int, default=90)
+parser.add_argument('--calendar-events', type=int, nargs='+',
+        default=[250, 2500, 25000])
+
+args = parser.parse_args()
+
+if args.benchmark == "queries":
+    bench_queries(args)
+
+if args.benchmark == "history":
+    bench_history(args)
+
+if args.benchmark == "daemon":
+    bench_daemon(args)
+
+if args.benchmark == "stress":
+    bench_stress(args)
+
+if args.benchmark == "nodes":
+    bench_nodes(args)
+
+if args.benchmark == "threads":
+    bench_threads(args)
+
+if args.benchmark == "alerts":
+    bench_alerts(args)
+
+if args.benchmark == "report":
+    bench_report(args)
+
+if args.benchmark == "calendar":
+    bench_calendar(args)
+
+if args.benchmark == "stress-reader":
+    stress_reader(args)
+
+if args.benchmark == "stress-writer":
+    stress_writer(args)
+
+if args.benchmark == "history-writer":
+    write_history(args.filename, args.durability, args.events)
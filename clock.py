@@ -0,0 +1,66 @@
+import os
+import select
+import time
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _librt = ctypes.CDLL(ctypes.util.find_library("rt") or "libc.so.6",
+            use_errno=True)
+    _CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        """Seconds on a clock that never jumps when the wall time is set."""
+        t = _timespec()
+        if _librt.clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class SystemClock(object):
+    """The real clocks. Anything that reads the time or waits takes one of
+    these, so that a VirtualClock can stand in for it."""
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def select(self, fds, timeout):
+        """Wait up to timeout seconds for one of fds to become readable."""
+        return select.select(fds, [], [], timeout)[0]
+
+
+class VirtualClock(object):
+    """A clock that only moves when the program waits on it.
+
+    Waiting returns immediately, having advanced the clock by the full
+    timeout, so a program driven by it runs as fast as it can compute while
+    seeing time pass exactly as it asked.
+    """
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+    def select(self, fds, timeout):
+        self.sleep(timeout)
+        return []
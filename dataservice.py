@@ -0,0 +1,138 @@
+import BaseHTTPServer
+import json
+import threading
+import time
+import urlparse
+
+
+
+# Default and largest number of history rows in one response
+HISTORY_LIMIT = 1000
+MAX_HISTORY_LIMIT = 5000
+# Window returned by /api/history when none is given
+DEFAULT_HISTORY_WINDOW = 24*60*60
+
+
+def history_json(rows):
+    return [{"id": row[0], "timestamp": row[1], "device": row[2],
+             "enabled": row[3]} for row in rows]
+
+
+class DataService(object):
+    """Serves the dashboard's data as JSON over HTTP on a background thread.
+
+    GET /api/devices
+        Every device with a summary the daemon keeps up to date as it runs
+        them (see publish): whether it is on and since when, seconds on and
+        runs started today, and the next scheduled run. Also returns the
+        history cursor to pass to /api/changes.
+    GET /api/history?from=T&to=T[&device=N][&limit=N]
+        History rows with timestamps in [from, to), by default the last day.
+    GET /api/changes?since=ID[&limit=N]
+        History rows added after the one with ID since, and the cursor for
+        the next call. "more" is set if limit cut the response short.
+
+    Every response is bounded by the number of devices or by limit, and
+    every query is an index range scan, so neither grows with the history.
+    Queries go through the daemon's db.DB on a connection of their own, and
+    write out any history it has buffered first.
+    """
+    def __init__(self, database, port, host="127.0.0.1"):
+        self.database = database
+        # {device_id: summary dict}, written by the control loop
+        self.summaries = {}
+        self.lock = threading.Lock()
+
+        service = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse.urlparse(self.path)
+                params = dict((key, values[-1]) for (key, values) in
+                        urlparse.parse_qs(url.query).items())
+                route = {
+                    "/api/devices": service.get_devices,
+                    "/api/history": service.get_history,
+                    "/api/changes": service.get_changes,
+                }.get(url.path)
+                if route is None:
+                    self.send_error(404)
+                    return
+                try:
+                    body = json.dumps(route(params))
+                except ValueError, e:
+                    self.send_error(400, str(e))
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                name="data")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def publish(self, device_id, summary):
+        """Replace a device's summary. Called from the control loop."""
+        with self.lock:
+            self.summaries[device_id] = summary
+
+    def remove(self, device_id):
+        with self.lock:
+            self.summaries.pop(device_id, None)
+
+    def get_devices(self, params):
+        with self.lock:
+            summaries = dict(self.summaries)
+        devices = {}
+        for row in self.database.list_devices():
+            devices[row[0]] = {
+                "device_id": row[0],
+                "group_id": row[1],
+                "type": row[2],
+                "display_name": row[3],
+                "pin": row[4],
+                "node": row[5],
+                "summary": summaries.get(row[0]),
+            }
+        return {
+            "now": time.time(),
+            "cursor": self.database.get_last_history_id(),
+            "devices": devices,
+        }
+
+    def get_limit(self, params):
+        return min(int(params.get("limit", HISTORY_LIMIT)), MAX_HISTORY_LIMIT)
+
+    def get_history(self, params):
+        to_timestamp = int(params.get("to", time.time()))
+        from_timestamp = int(params.get("from",
+                to_timestamp - DEFAULT_HISTORY_WINDOW))
+        device = params.get("device")
+        rows = self.database.get_history_window(from_timestamp, to_timestamp,
+                int(device) if device is not None else None,
+                self.get_limit(params))
+        return {"history": history_json(rows)}
+
+    def get_changes(self, params):
+        since = int(params.get("since", 0))
+        limit = self.get_limit(params)
+        rows = self.database.get_history_since(since, limit)
+        return {
+            "history": history_json(rows),
+            "cursor": rows[-1][0] if rows else since,
+            "more": len(rows) == limit,
+        }
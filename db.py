@@ -1,94 +1,993 @@
+import contextlib
 import datetime
 import sqlite3
+import threading
 import time
 
+import log
+from clock import SystemClock
+
+
+# Each entry upgrades the schema by one version; the index into this list plus
+# one is the resulting PRAGMA user_version. Only ever append to this list.
+MIGRATIONS = [
+    # 1: Original schema. Databases created before versioning already have
+    # these tables, so every statement must be a no-op for them.
+    [
+        '''CREATE TABLE IF NOT EXISTS devices
+           (device_id integer, group_id integer, type string, display_name string, pin integer)''',
+        '''CREATE TABLE IF NOT EXISTS device_history
+           (timestamp integer, device integer, enabled integer)''',
+        '''CREATE TABLE IF NOT EXISTS device_schedule
+           (timestamp integer, device integer, start_time integer,
+            duration integer, min_duration integer)''',
+        '''CREATE TABLE IF NOT EXISTS access_tokens
+           (access_token string, refresh_token string)''',
+        '''CREATE TABLE IF NOT EXISTS globals
+           (name string, value string)''',
+    ],
+    # 2: Covering indexes for the per-poll history and schedule lookups.
+    [
+        '''CREATE INDEX IF NOT EXISTS device_history_device_timestamp
+           ON device_history (device, timestamp, enabled)''',
+        '''CREATE INDEX IF NOT EXISTS device_schedule_device_timestamp
+           ON device_schedule (device, timestamp)''',
+        '''CREATE INDEX IF NOT EXISTS device_schedule_device_start_time
+           ON device_schedule (device, start_time)''',
+    ],
+    # 3: Primary keys on devices and globals. SQLite cannot add a primary key
+    # to an existing table, so rebuild both, keeping the most recent row for
+    # any duplicated key.
+    [
+        '''CREATE TABLE devices_new
+           (device_id integer PRIMARY KEY, group_id integer, type string,
+            display_name string, pin integer)''',
+        '''INSERT OR REPLACE INTO devices_new
+           SELECT device_id, group_id, type, display_name, pin FROM devices
+           ORDER BY rowid''',
+        '''DROP TABLE devices''',
+        '''ALTER TABLE devices_new RENAME TO devices''',
+        '''CREATE TABLE globals_new
+           (name string PRIMARY KEY, value string)''',
+        '''INSERT OR REPLACE INTO globals_new
+           SELECT name, value FROM globals ORDER BY rowid''',
+        '''DROP TABLE globals''',
+        '''ALTER TABLE globals_new RENAME TO globals''',
+    ],
+    # 4: Per-device daily summaries of history that has been compacted.
+    [
+        '''CREATE TABLE device_daily
+           (device integer, day integer, seconds_on integer,
+            activations integer, first_on integer, last_on integer,
+            on_at_end integer, PRIMARY KEY (device, day))''',
+    ],
+    # 5: Remember which calendar event each schedule row came from, and its
+    # ETag, so calendar syncs can apply changes instead of starting over.
+    # Rows from before this were written by the calendar sync (the daemon
+    # ran nothing else), so they get a placeholder event, which the next
+    # full sync replaces with the real ones.
+    [
+        '''ALTER TABLE device_schedule ADD COLUMN event_id string''',
+        '''ALTER TABLE device_schedule ADD COLUMN etag string''',
+        '''UPDATE device_schedule SET event_id = 'unsynced-' || rowid''',
+        '''DELETE FROM globals WHERE name IN ('gcsynctoken')''',
+        '''CREATE INDEX device_schedule_event_id
+           ON device_schedule (event_id)''',
+    ],
+    # 6: Recurring schedule rows. rrule is a subset of an RFC 5545 RRULE
+    # (see schedules.Recurrence) and exdates a comma-separated list of
+    # YYYY-MM-DD dates to skip.
+    [
+        '''ALTER TABLE device_schedule ADD COLUMN rrule string''',
+        '''ALTER TABLE device_schedule ADD COLUMN exdates string''',
+    ],
+    # 7: How many devices in a group may be on at once. Groups without a row
+    # allow one.
+    [
+        '''CREATE TABLE device_groups
+           (group_id integer PRIMARY KEY, capacity integer)''',
+    ],
+    # 8: Give history rows an ID that only ever increases, even when the
+    # newest rows are deleted, so clients can ask for changes since one.
+    [
+        '''CREATE TABLE device_history_new
+           (id integer PRIMARY KEY AUTOINCREMENT, timestamp integer,
+            device integer, enabled integer)''',
+        '''INSERT INTO device_history_new (timestamp, device, enabled)
+           SELECT timestamp, device, enabled FROM device_history
+           ORDER BY timestamp, rowid''',
+        '''DROP TABLE device_history''',
+        '''ALTER TABLE device_history_new RENAME TO device_history''',
+        '''CREATE INDEX device_history_device_timestamp
+           ON device_history (device, timestamp, enabled)''',
+        # For time windows across all devices
+        '''CREATE INDEX device_history_timestamp
+           ON device_history (timestamp)''',
+    ],
+    # 9: How much water a device uses per minute it is on, for reports.
+    # NULL when unknown.
+    [
+        '''ALTER TABLE devices ADD COLUMN flow_rate real''',
+    ],
+    # 10: Which daemon controls each device, for several sharing a database.
+    # NULL is the daemon run without --node. Groups with devices on more than
+    # one node share their capacity through leases: a row per device that
+    # holds a slot (granted) or is waiting for one, kept alive by its node
+    # until expires.
+    [
+        '''ALTER TABLE devices ADD COLUMN node string''',
+        '''CREATE TABLE group_leases
+           (group_id integer, device integer, node string, deadline real,
+            remaining integer, granted integer, expires integer,
+            PRIMARY KEY (group_id, device))''',
+    ],
+    # 11: Alerts waiting to be emailed (see alerts.py). Repeats of an unsent
+    # alert with the same key are folded into it; sent rows are kept for a
+    # while to hold back repeats.
+    [
+        '''CREATE TABLE alerts
+           (id integer PRIMARY KEY, key string, subject string, body string,
+            count integer, first_seen real, last_seen real, attempts integer,
+            next_attempt real, sent real)''',
+        '''CREATE INDEX alerts_key ON alerts (key, sent)''',
+        '''CREATE INDEX alerts_due ON alerts (sent, next_attempt)''',
+    ],
+]
+
+# Devices that may be on at once in a group without a device_groups row
+DEFAULT_GROUP_CAPACITY = 1
+
+# Names of the globals counting changes to devices (and device_groups) and
+# device_schedule
+DEVICES_GENERATION = "devices_generation"
+SCHEDULE_GENERATION = "schedule_generation"
+
+# Raw history older than this many days is rolled up into device_daily and
+# deleted. Override with the history_retention_days global.
+DEFAULT_HISTORY_RETENTION_DAYS = 90
+
+
+def day_start(timestamp):
+    """Local midnight at or before the given time."""
+    date = datetime.date.fromtimestamp(timestamp)
+    return int(time.mktime(date.timetuple()))
+
+
+def next_day_start(day):
+    """Local midnight following the given day's midnight."""
+    date = datetime.date.fromtimestamp(day) + datetime.timedelta(1)
+    return int(time.mktime(date.timetuple()))
+
+
+def to_schedule_timestamp(start_time):
+    """Convert a schedule's naive local datetime to its stored timestamp."""
+    return (start_time - datetime.datetime(1970, 1, 1)).total_seconds() + (7*60*60)
+
+
+def from_schedule_timestamp(timestamp):
+    """Inverse of to_schedule_timestamp."""
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(
+        seconds=timestamp - (7*60*60))
+
+
+def summarize_days(history, on_since=None, end=None):
+    """Roll (timestamp, enabled) rows, oldest first, up into days.
+
+    on_since is when the device turned on, if it was already on before the
+    first row. A run still going after the last row is counted up to end.
+
+    Returns ({day: [seconds_on, activations, first_on, last_on]}, on_since)
+    where the returned on_since is set if the device was left on.
+    """
+    days = {}
+
+    def add_runtime(start, stop):
+        # Split runs that cross midnight between the days they cover
+        while start < stop:
+            day = day_start(start)
+            boundary = min(stop, next_day_start(day))
+            days.setdefault(day, [0, 0, None, None])[0] += boundary - start
+            start = boundary
+
+    for (timestamp, enabled) in history:
+        if enabled:
+            if on_since is None:
+                on_since = timestamp
+                summary = days.setdefault(
+                    day_start(timestamp), [0, 0, None, None])
+                summary[1] += 1
+                if summary[2] is None:
+                    summary[2] = timestamp
+                summary[3] = timestamp
+        elif on_since is not None:
+            add_runtime(on_since, timestamp)
+            on_since = None
+
+    if on_since is not None and end is not None:
+        add_runtime(on_since, end)
+    return (days, on_since)
+
+
+# Commit every history event as it is logged.
+DURABILITY_STRICT = "strict"
+# Buffer history events in memory and commit them in groups. A crash or power
+# loss can lose up to flush_interval seconds of history.
+DURABILITY_BATCHED = "batched"
+
+# Seconds to wait for another connection's write to finish before giving up
+# with "database is locked". Readers never make us wait (see WAL below).
+DEFAULT_BUSY_TIMEOUT = 10
+# Times to retry starting a write transaction that timed out that way, after
+# BUSY_RETRY_DELAY seconds and then twice as long each time
+DEFAULT_BUSY_RETRIES = 2
+BUSY_RETRY_DELAY = 0.1
+
+# Prepared statements kept per connection, by SQL text. The statements run on
+# every poll are constants below so that each call reuses one.
+CACHED_STATEMENTS = 256
+
+INSERT_HISTORY = '''INSERT INTO device_history (timestamp, device, enabled)
+                    VALUES (?, ?, ?)'''
+SELECT_DEVICE_HISTORY = '''SELECT timestamp, enabled FROM device_history
+                           WHERE device = ? AND timestamp > ?
+                           ORDER BY timestamp, id'''
+SELECT_DEVICE_SCHEDULE = '''SELECT timestamp, start_time, duration, min_duration,
+                                 rrule, exdates
+                            FROM device_schedule
+                            WHERE device = ?
+                            ORDER BY timestamp DESC'''
+
+
+def is_locked(error):
+    """Whether a sqlite3.OperationalError means another connection held the
+    write lock for longer than the busy timeout."""
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+class Cursor(sqlite3.Cursor):
+    """A cursor that counts the statements it runs on its connection."""
+    def execute(self, *args):
+        self.connection.statements += 1
+        return sqlite3.Cursor.execute(self, *args)
+
+    def executemany(self, *args):
+        self.connection.statements += 1
+        return sqlite3.Cursor.executemany(self, *args)
+
+
+class Connection(sqlite3.Connection):
+    """A connection whose cursors count statements, for benchmarks."""
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.statements = 0
+
+    def cursor(self, factory=Cursor):
+        return sqlite3.Connection.cursor(self, factory)
+
 
 class DB(object):
-    def __init__(self, filename, logger):
-        self.conn = sqlite3.connect(filename)
+    """The database, for any number of threads.
+
+    Each thread gets its own connection the first time it uses one (see
+    conn), so a single DB can be shared by the control loop, the calendar
+    sync and the data service. Connections run in autocommit mode; every
+    write goes through transaction(). Buffered history is shared, and
+    whichever thread commits next writes it out.
+    """
+    def __init__(self, filename, logger, durability=DURABILITY_STRICT,
+                 batch_size=64, flush_interval=60, clock=None,
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT,
+                 busy_retries=DEFAULT_BUSY_RETRIES):
+        self.filename = filename
+        self.busy_timeout = busy_timeout
+        self.busy_retries = busy_retries
         self.logger = logger
-        
-        c = self.conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS devices 
-                     (device_id integer, group_id integer, type string, display_name string, pin integer)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS device_history 
-                     (timestamp integer, device integer, enabled integer)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS device_schedule
-                     (timestamp integer, device integer, start_time integer,
-                      duration integer, min_duration integer)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS access_tokens
-                     (access_token string, refresh_token string)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS globals
-                     (name string, value string)''')
-        self.conn.commit()
+        # Source of the current time for timestamps; see clock.py
+        self.clock = clock or SystemClock()
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # History rows waiting to be committed, and when the oldest was
+        # logged. self.lock guards these and self.connections.
+        self.pending_history = []
+        self.pending_since = None
+        self.commits = 0
+
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.connections = []
+
+        # WAL lets readers proceed while we write, and lets us write while
+        # they read, and turns each commit into a single append to the log.
+        # It is a property of the file, so setting it once covers every
+        # connection.
+        # (Fetch the result so the statement doesn't stay open, which would
+        # stop transactions on this connection from committing.)
+        c = self.conn.cursor()
+        c.execute("PRAGMA journal_mode = WAL").fetchall()
+
+        self.migrate()
 
         if self.logger:
             self.logger.write_log("Opened Sqlite database.")
 
-    def log_device_enabled(self, device, enabled):
-        timestamp = int(time.time())
+    @property
+    def conn(self):
+        """This thread's connection, opened the first time it asks."""
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            return conn
+
+        # Other threads' connections are only ever used by them, except
+        # that close() closes them all
+        conn = sqlite3.connect(self.filename, timeout=self.busy_timeout,
+                factory=Connection, isolation_level=None,
+                check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        # In batched mode commits are not synced at all; the log is synced
+        # when it is checkpointed.
+        c = conn.cursor()
+        if self.durability == DURABILITY_BATCHED:
+            c.execute("PRAGMA synchronous = NORMAL")
+        else:
+            c.execute("PRAGMA synchronous = FULL")
+
+        self.local.conn = conn
+        # Cached generation counters, valid while this connection's
+        # data_version is unchanged
+        self.local.data_version = None
+        self.local.generations = {}
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self, retries=None):
+        """Run the body as one write transaction, on this thread's
+        connection, and commit any buffered history with it.
+
+        The write lock is taken before the body runs (BEGIN IMMEDIATE). If
+        another connection holds it past the busy timeout, that is retried
+        up to retries times (busy_retries by default) before the
+        OperationalError is raised, so a busy database fails a write before
+        any of it is done rather than halfway through.
+
+        The body gets a cursor. If it raises, the transaction is rolled back
+        and the history stays buffered. Transactions don't nest.
+        """
+        if retries is None:
+            retries = self.busy_retries
+        c = self.conn.cursor()
+        delay = BUSY_RETRY_DELAY
+        for attempt in xrange(retries + 1):
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError, e:
+                if not is_locked(e) or attempt == retries:
+                    raise
+                self.clock.sleep(delay)
+                delay *= 2
+
+        with self.lock:
+            (history, self.pending_history) = (self.pending_history, [])
+            (pending_since, self.pending_since) = (self.pending_since, None)
+        try:
+            yield c
+            if history:
+                c.executemany(INSERT_HISTORY, history)
+            c.execute("COMMIT")
+        except:
+            try:
+                c.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                # SQLite already rolled back after the error
+                pass
+            with self.lock:
+                self.pending_history[:0] = history
+                if history:
+                    self.pending_since = pending_since
+            raise
+        self.commits += 1
+
+    def get_schema_version(self):
         c = self.conn.cursor()
-        c.execute("INSERT INTO device_history VALUES (?, ?, ?)", (
-            timestamp, device, 1 if enabled else 0))
-        self.conn.commit()
+        c.execute("PRAGMA user_version")
+        return c.fetchone()[0]
+
+    def migrate(self, target_version=len(MIGRATIONS)):
+        """Upgrade the schema in place, one version per transaction."""
+        version = self.get_schema_version()
+        if version >= target_version:
+            return
+
+        while version < target_version:
+            with self.transaction() as c:
+                for statement in MIGRATIONS[version]:
+                    c.execute(statement)
+                c.execute("PRAGMA user_version = %d" % (version + 1))
+            version += 1
+            if self.logger:
+                self.logger.write_log(
+                    "Migrated Sqlite database to version %d." % version)
+
+    def flush(self):
+        """Write out buffered history, if there is any.
+
+        If another connection keeps the database locked, the rows stay
+        buffered for the next try and False is returned, so that history
+        logging never takes down the caller.
+        """
+        if not self.pending_history:
+            return True
+        try:
+            # Callers include the control loop, which mustn't wait long
+            with self.transaction(retries=0):
+                pass
+        except sqlite3.OperationalError, e:
+            if not is_locked(e):
+                raise
+            if self.logger:
+                self.logger.write_log(
+                    "### Couldn't write %d history rows: %s. Will retry." % (
+                        len(self.pending_history), e), log.WARNING)
+            return False
+        return True
+
+    def log_device_enabled(self, device, enabled):
+        timestamp = int(self.clock.time())
+        with self.lock:
+            self.pending_history.append(
+                    (timestamp, device, 1 if enabled else 0))
+            if self.pending_since is None:
+                self.pending_since = timestamp
+
+        if (self.durability != DURABILITY_BATCHED or
+                len(self.pending_history) >= self.batch_size or
+                timestamp - self.pending_since >= self.flush_interval):
+            self.flush()
 
     def list_devices(self):
+        """(device_id, group_id, type, display_name, pin, node) for every
+        device on every node."""
         c = self.conn.cursor()
         rows = c.execute(
-            '''SELECT device_id, group_id, type, display_name, pin FROM devices''')
+            '''SELECT device_id, group_id, type, display_name, pin, node
+               FROM devices''')
         return list(rows)
 
-    def add_device(self, device_id, group, type, display_name, pin):
+    def _bump_generation(self, c, name):
+        """Mark a set of tables as changed; see get_generation."""
+        c.execute('''INSERT OR IGNORE INTO globals VALUES (?, '0')''', (name,))
+        c.execute(
+            '''UPDATE globals SET value = CAST(value AS integer) + 1
+               WHERE name = ?''',
+            (name,))
+        self.local.generations.pop(name, None)
+
+    def get_generation(self, name):
+        """A value that changes whenever the named data does.
+
+        DEVICES_GENERATION covers the devices table and SCHEDULE_GENERATION
+        the device_schedule table. Every method here that writes them bumps
+        the counter. PRAGMA data_version tells us without any I/O whether
+        another connection has committed, so while nothing changes this
+        costs no reads at all.
+        """
         c = self.conn.cursor()
-        c.execute("INSERT INTO devices VALUES (?, ?, ?, ?, ?)", (
-            device_id, group, type, display_name, pin))
-        self.conn.commit()
+        c.execute("PRAGMA data_version")
+        data_version = c.fetchone()[0]
+        local = self.local
+        if data_version != local.data_version:
+            local.data_version = data_version
+            local.generations = {}
+        if name not in local.generations:
+            local.generations[name] = self.get_global(name, "0")
+        return local.generations[name]
+
+    def add_device(self, device_id, group, type, display_name, pin,
+                   node=None):
+        """Add a device, or replace the one with the same ID."""
+        with self.transaction() as c:
+            c.execute(
+                '''INSERT OR REPLACE INTO devices
+                   (device_id, group_id, type, display_name, pin, node)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                (device_id, group, type, display_name, pin, node))
+            self._bump_generation(c, DEVICES_GENERATION)
+
+    def remove_device(self, device_id):
+        with self.transaction() as c:
+            c.execute("DELETE FROM devices WHERE device_id = ?", (device_id,))
+            self._bump_generation(c, DEVICES_GENERATION)
+
+    def get_flow_rates(self):
+        """{device_id: flow rate per minute} for devices that have one."""
+        c = self.conn.cursor()
+        return dict(c.execute(
+            '''SELECT device_id, flow_rate FROM devices
+               WHERE flow_rate IS NOT NULL'''))
+
+    def set_flow_rate(self, device_id, flow_rate):
+        with self.transaction() as c:
+            c.execute("UPDATE devices SET flow_rate = ? WHERE device_id = ?", (
+                flow_rate, device_id))
+
+    def get_group_capacities(self):
+        """{group_id: capacity} for groups that don't use the default."""
+        c = self.conn.cursor()
+        return dict(c.execute(
+            '''SELECT group_id, capacity FROM device_groups'''))
+
+    def set_group_capacity(self, group, capacity):
+        with self.transaction() as c:
+            if capacity == DEFAULT_GROUP_CAPACITY:
+                c.execute("DELETE FROM device_groups WHERE group_id = ?", (group,))
+            else:
+                c.execute("INSERT OR REPLACE INTO device_groups VALUES (?, ?)", (
+                    group, capacity))
+            self._bump_generation(c, DEVICES_GENERATION)
+
+    def request_group_slot(self, group, device, node, capacity, deadline,
+                           remaining, ttl):
+        """Ask for one of a group's slots on behalf of a device, among every
+        node sharing the group.
+
+        Free slots go to the waiting devices with the earliest deadline, and
+        then the least remaining, whichever node they are on. Returns True
+        if the device holds a slot; otherwise its request is recorded (or
+        its place in the queue updated) and it should ask again. Either way
+        the lease lasts ttl seconds unless renewed (see renew_group_leases),
+        and those of nodes that stopped renewing are dropped. Raises
+        OperationalError if the database is too busy to say.
+        """
+        now = int(self.clock.time())
+        with self.transaction(retries=0) as c:
+            c.execute("DELETE FROM group_leases WHERE expires < ?", (now,))
+            c.execute(
+                '''SELECT granted FROM group_leases
+                   WHERE group_id = ? AND device = ?''',
+                (group, device))
+            row = c.fetchone()
+            granted = bool(row and row[0])
+            c.execute(
+                '''INSERT OR REPLACE INTO group_leases
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (group, device, node, deadline, remaining, 1 if granted else 0,
+                 now + ttl))
+            if granted:
+                return True
+
+            c.execute(
+                '''SELECT COUNT(*) FROM group_leases
+                   WHERE group_id = ? AND granted''',
+                (group,))
+            free = capacity - c.fetchone()[0]
+            if free <= 0:
+                return False
+            first = [row[0] for row in c.execute(
+                '''SELECT device FROM group_leases
+                   WHERE group_id = ? AND NOT granted
+                   ORDER BY deadline, remaining, device LIMIT ?''',
+                (group, free))]
+            if device not in first:
+                return False
+            c.execute(
+                '''UPDATE group_leases SET granted = 1
+                   WHERE group_id = ? AND device = ?''',
+                (group, device))
+            return True
+
+    def release_group_slot(self, group, device):
+        """Give up a device's slot in, or place in the queue for, a group."""
+        with self.transaction(retries=0) as c:
+            c.execute(
+                '''DELETE FROM group_leases
+                   WHERE group_id = ? AND device = ?''',
+                (group, device))
+
+    def renew_group_leases(self, node, devices, ttl):
+        """Extend the leases of the given devices on a node by ttl seconds
+        from now, and drop any others the node has, which it must have
+        failed to release."""
+        now = int(self.clock.time())
+        with self.transaction(retries=0) as c:
+            for row in c.execute(
+                    '''SELECT device FROM group_leases WHERE node IS ?''',
+                    (node,)).fetchall():
+                if row[0] in devices:
+                    c.execute(
+                        '''UPDATE group_leases SET expires = ?
+                           WHERE device = ?''',
+                        (now + ttl, row[0]))
+                else:
+                    c.execute(
+                        '''DELETE FROM group_leases WHERE device = ?''',
+                        (row[0],))
+
+    def get_group_holders(self, group):
+        """(device, node) for the devices holding one of a group's slots."""
+        c = self.conn.cursor()
+        return c.execute(
+            '''SELECT device, node FROM group_leases
+               WHERE group_id = ? AND granted AND expires >= ?
+               ORDER BY device''',
+            (group, int(self.clock.time()))).fetchall()
 
     def get_device_history(self, device, from_timestamp):
+        self.flush()
         c = self.conn.cursor()
-        rows = c.execute(
-            '''SELECT timestamp, enabled FROM device_history
-               WHERE device = ? AND timestamp > ?
-               ORDER BY timestamp''',
-            (device, from_timestamp))
+        return c.execute(SELECT_DEVICE_HISTORY,
+                (device, from_timestamp)).fetchall()
+
+    def get_history_window(self, from_timestamp, to_timestamp, device=None,
+                           limit=5000):
+        """(id, timestamp, device, enabled) rows in [from, to), oldest first.
+
+        At most limit rows are returned; if that many come back, ask again
+        from the last timestamp.
+        """
+        self.flush()
+        c = self.conn.cursor()
+        if device is None:
+            rows = c.execute(
+                '''SELECT id, timestamp, device, enabled FROM device_history
+                   WHERE timestamp >= ? AND timestamp < ?
+                   ORDER BY timestamp, id LIMIT ?''',
+                (from_timestamp, to_timestamp, limit))
+        else:
+            rows = c.execute(
+                '''SELECT id, timestamp, device, enabled FROM device_history
+                   WHERE device = ? AND timestamp >= ? AND timestamp < ?
+                   ORDER BY timestamp, id LIMIT ?''',
+                (device, from_timestamp, to_timestamp, limit))
         return list(rows)
 
-    def clear_device_history(self, device):
+    def get_history_since(self, after_id, limit=1000):
+        """(id, timestamp, device, enabled) rows added after the row with ID
+        after_id, in the order they were added.
+
+        IDs only increase, so the last ID returned is the cursor for the
+        next call. This is a range scan on the primary key, so its cost
+        doesn't grow with the size of the table.
+        """
+        self.flush()
+        c = self.conn.cursor()
+        return list(c.execute(
+            '''SELECT id, timestamp, device, enabled FROM device_history
+               WHERE id > ? ORDER BY id LIMIT ?''',
+            (after_id, limit)))
+
+    def get_last_history_id(self):
+        """The cursor to pass to get_history_since for changes from now on."""
+        self.flush()
         c = self.conn.cursor()
         c.execute(
-            '''DELETE FROM device_history WHERE device = ?''',
-            (device,))
-        self.conn.commit()
+            "SELECT seq FROM sqlite_sequence WHERE name = 'device_history'")
+        row = c.fetchone()
+        return row[0] if row else 0
 
-    def get_device_schedule(self, device):
+    def get_history_columns(self, from_timestamp, to_timestamp):
+        """(device, timestamp, enabled) rows in [from, to), ordered by device
+        and then time, as one list for bulk loading."""
+        self.flush()
         c = self.conn.cursor()
-        return [row for row in c.execute(
-            '''SELECT timestamp, start_time, duration, min_duration FROM device_schedule
-               WHERE device = ?
-               ORDER BY timestamp DESC''',
-            (device,))]
+        return c.execute(
+            '''SELECT device, timestamp, enabled FROM device_history
+               WHERE timestamp >= ? AND timestamp < ?
+               ORDER BY device, timestamp, id''',
+            (from_timestamp, to_timestamp)).fetchall()
 
-    def set_device_schedule(self, device, start_time, duration, min_duration):
-        timestamp = (start_time - datetime.datetime(1970, 1, 1)).total_seconds() + (7*60*60)
+    def get_history_on_since(self, timestamp):
+        """{device: on_since} for pairing up history rows from the given
+        time on: the devices that were on at that time.
+
+        Comes from the last history row before it, or for devices whose
+        history before it has been compacted, from the rollups. A device
+        compacted past the given time has no rows until the day after its
+        last rollup, so it is only included if that rollup ended on, and
+        then as on since that midnight; the days before it are for the
+        rollups alone to account for.
+        """
+        self.flush()
         c = self.conn.cursor()
+        on_since = {}
+        for (day, device, on_at_end) in c.execute(
+                '''SELECT MAX(day), device, on_at_end FROM device_daily
+                   GROUP BY device'''):
+            if on_at_end:
+                on_since[device] = next_day_start(day)
+        for (last_id, device, enabled, last_on) in c.execute(
+                '''SELECT MAX(id), device, enabled, timestamp
+                   FROM device_history
+                   WHERE timestamp < ? GROUP BY device''',
+                (timestamp,)):
+            if enabled:
+                on_since[device] = last_on
+            else:
+                on_since.pop(device, None)
+        return on_since
+
+    def get_raw_history_start(self):
+        """Midnight starting the first day with every device's raw history,
+        or None if there is no history."""
+        c = self.conn.cursor()
+        c.execute("SELECT MIN(timestamp) FROM device_history")
+        oldest = c.fetchone()[0]
+        c.execute("SELECT MAX(day) FROM device_daily")
+        last_rollup = c.fetchone()[0]
+        if last_rollup is None:
+            return day_start(oldest) if oldest is not None else None
+        start = next_day_start(last_rollup)
+        if oldest is not None:
+            start = max(start, day_start(oldest))
+        return start
+
+    def get_daily_rollups(self, from_timestamp, to_timestamp):
+        """(device, day, seconds_on, activations) for compacted days in
+        [from, to)."""
+        c = self.conn.cursor()
+        return c.execute(
+            '''SELECT device, day, seconds_on, activations FROM device_daily
+               WHERE day >= ? AND day < ?''',
+            (from_timestamp, to_timestamp)).fetchall()
+
+    def count_history(self):
+        """Rows in device_history, including ones not yet written."""
+        c = self.conn.cursor()
+        c.execute("SELECT COUNT(*) FROM device_history")
+        return c.fetchone()[0] + len(self.pending_history)
+
+    def clear_device_history(self, device):
+        self.flush()
+        with self.transaction() as c:
+            c.execute(
+                '''DELETE FROM device_history WHERE device = ?''',
+                (device,))
+            c.execute(
+                '''DELETE FROM device_daily WHERE device = ?''',
+                (device,))
+
+    def _get_rolled_up_on_since(self, c, device, before_day):
+        """When the device was on since according to the rollups, if at all."""
         c.execute(
-            '''INSERT INTO device_schedule VALUES (?, ?, ?, ?, ?)''',
-            (int(time.time()), device, timestamp, duration, min_duration))
-        self.conn.commit()
+            '''SELECT day, on_at_end FROM device_daily
+               WHERE device = ? AND day < ?
+               ORDER BY day DESC LIMIT 1''',
+            (device, before_day))
+        row = c.fetchone()
+        if row and row[1]:
+            return next_day_start(row[0])
+        return None
+
+    def get_device_daily(self, device, from_timestamp, to_timestamp):
+        """Per-day runtime for the days overlapping the given range.
+
+        Days that have been compacted come from device_daily; the rest are
+        computed from the raw history. Returns a list of (day, seconds_on,
+        activations, first_on, last_on) for days with any rows.
+        """
+        self.flush()
+        c = self.conn.cursor()
+        from_day = day_start(from_timestamp)
+        days = {}
+        for row in c.execute(
+                '''SELECT day, seconds_on, activations, first_on, last_on
+                   FROM device_daily
+                   WHERE device = ? AND day >= ? AND day < ?
+                     AND (seconds_on > 0 OR activations > 0)''',
+                (device, from_day, to_timestamp)):
+            days[row[0]] = list(row[1:])
+
+        # Raw history only covers the retention period, so this stays small
+        on_since = self._get_rolled_up_on_since(c, device, to_timestamp)
+        history = c.execute(
+            '''SELECT timestamp, enabled FROM device_history
+               WHERE device = ? AND timestamp < ?
+               ORDER BY timestamp, id''',
+            (device, to_timestamp))
+        (raw_days, on_since) = summarize_days(
+            history, on_since, min(to_timestamp, int(self.clock.time())))
+        for (day, summary) in raw_days.items():
+            if day >= from_day:
+                days[day] = summary
+
+        return [tuple([day] + days[day]) for day in sorted(days)]
+
+    def compact_history(self, retention_days=None):
+        """Roll up and delete one device-day of history past retention.
+
+        Each call does a small, bounded amount of work so that it can be
+        interleaved with device control. Returns True if anything was
+        compacted, in which case there may be more to do.
+        """
+        self.flush()
+        if retention_days is None:
+            retention_days = int(self.get_global(
+                "history_retention_days", DEFAULT_HISTORY_RETENTION_DAYS))
+        cutoff = day_start(self.clock.time() - retention_days * 24*60*60)
+
+        c = self.conn.cursor()
+        # The oldest row overall is also the oldest of its device, so this
+        # one lookup on the timestamp index finds the next device-day
+        oldest = c.execute(
+            '''SELECT device, timestamp FROM device_history
+               WHERE timestamp < ? ORDER BY timestamp LIMIT 1''',
+            (cutoff,)).fetchall()
+        if not oldest:
+            return False
+        (device, timestamp) = oldest[0]
+
+        day = day_start(timestamp)
+        end = next_day_start(day)
+        history = c.execute(
+            '''SELECT timestamp, enabled FROM device_history
+               WHERE device = ? AND timestamp < ?
+               ORDER BY timestamp, id''',
+            (device, end)).fetchall()
+        (days, on_since) = summarize_days(
+            history, self._get_rolled_up_on_since(c, device, day), end)
+        days.setdefault(day, [0, 0, None, None])
+
+        # Any earlier days are ones a single run lasted through
+        rollups = []
+        for (summary_day, summary) in days.items():
+            on_at_end = summary_day < day or on_since is not None
+            rollups.append((device, summary_day) + tuple(summary) +
+                    (1 if on_at_end else 0,))
+        try:
+            with self.transaction(retries=0) as c:
+                c.executemany(
+                    '''INSERT OR REPLACE INTO device_daily
+                       VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    rollups)
+                c.execute(
+                    '''DELETE FROM device_history
+                       WHERE device = ? AND timestamp < ?''',
+                    (device, end))
+        except sqlite3.OperationalError, e:
+            if not is_locked(e):
+                raise
+            # Some other connection is writing; this can wait
+            return False
+        return True
+
+    def get_device_schedule(self, device):
+        c = self.conn.cursor()
+        return c.execute(SELECT_DEVICE_SCHEDULE, (device,)).fetchall()
+
+    def set_device_schedule(self, device, start_time, duration, min_duration,
+                            rrule=None, exdates=None):
+        """Add a run at start_time, repeating according to rrule if given."""
+        timestamp = to_schedule_timestamp(start_time)
+        with self.transaction() as c:
+            c.execute(
+                '''INSERT INTO device_schedule
+                   (timestamp, device, start_time, duration, min_duration,
+                    rrule, exdates)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (int(self.clock.time()), device, timestamp, duration, min_duration,
+                 rrule, exdates))
+            self._bump_generation(c, SCHEDULE_GENERATION)
+
+    def get_manual_schedules(self, device=None):
+        """Schedule rows not owned by the calendar sync.
+
+        Returns sorted (device, start_time, duration, min_duration, rrule,
+        exdates) rows for one device, or for all of them.
+        """
+        c = self.conn.cursor()
+        query = '''SELECT device, start_time, duration, min_duration, rrule,
+                          exdates
+                   FROM device_schedule WHERE event_id IS NULL'''
+        params = ()
+        if device is not None:
+            query += " AND device = ?"
+            params = (device,)
+        return c.execute(query + '''
+            ORDER BY device, start_time, duration, min_duration, rrule,
+                     exdates''',
+            params).fetchall()
+
+    def replace_manual_schedules(self, schedules, device=None):
+        """Replace every schedule row not owned by the calendar sync.
+
+        schedules is a list of (device, start_time, duration, min_duration,
+        rrule, exdates) with start_time a datetime and the last two possibly
+        None. If device is given only that device's
+        rows are replaced and every entry must be for it. The whole set is
+        written in one transaction, and not at all if nothing changed.
+
+        Returns True if anything was written.
+        """
+        rows = sorted(
+            (entry_device, int(to_schedule_timestamp(start_time)),
+             int(duration), int(min_duration), rrule or None, exdates or None)
+            for (entry_device, start_time, duration, min_duration, rrule,
+                 exdates) in schedules)
+        if device is not None:
+            for row in rows:
+                if row[0] != device:
+                    raise ValueError(
+                        "Schedule entry for device %d, expected %d" % (
+                            row[0], device))
+        if rows == [tuple(row) for row in self.get_manual_schedules(device)]:
+            return False
+
+        timestamp = int(self.clock.time())
+        with self.transaction() as c:
+            if device is None:
+                c.execute('''DELETE FROM device_schedule WHERE event_id IS NULL''')
+            else:
+                c.execute(
+                    '''DELETE FROM device_schedule
+                       WHERE event_id IS NULL AND device = ?''',
+                    (device,))
+            c.executemany(
+                '''INSERT INTO device_schedule
+                   (timestamp, device, start_time, duration, min_duration,
+                    rrule, exdates)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                [(timestamp,) + row for row in rows])
+            self._bump_generation(c, SCHEDULE_GENERATION)
+        return True
 
     def clear_device_schedule(self, device):
+        with self.transaction() as c:
+            c.execute(
+                '''DELETE FROM device_schedule WHERE device = ?''',
+                (device,))
+            self._bump_generation(c, SCHEDULE_GENERATION)
+
+    def get_calendar_etags(self):
+        """Map of event ID to ETag for every calendar-sourced schedule row."""
         c = self.conn.cursor()
-        c.execute(
-            '''DELETE FROM device_schedule WHERE device = ?''',
-            (device,))
-        self.conn.commit()
+        return dict(c.execute(
+            '''SELECT event_id, etag FROM device_schedule
+               WHERE event_id IS NOT NULL'''))
 
-    def set_tokens(self, access_token, refresh_token):
+    def get_calendar_schedules(self):
+        """Calendar-sourced schedules as {device: [{start_time, duration}]}."""
         c = self.conn.cursor()
-        c.execute("DELETE FROM access_tokens")
-        c.execute("INSERT INTO access_tokens VALUES (?, ?)",
-                (access_token, refresh_token))
-        self.conn.commit()
+        schedules = {}
+        for row in c.execute(
+                '''SELECT device, start_time, duration FROM device_schedule
+                   WHERE event_id IS NOT NULL
+                   ORDER BY start_time'''):
+            schedules.setdefault(row[0], []).append({
+                "start_time": from_schedule_timestamp(row[1]),
+                "duration": row[2]
+            })
+        return schedules
+
+    def update_calendar_schedule(self, upserts, deletes):
+        """Apply a calendar sync's changes in one transaction.
+
+        upserts is a list of (event_id, etag, device, start_time, duration)
+        to add or replace; deletes is a list of event IDs to remove.
+        """
+        timestamp = int(self.clock.time())
+        with self.transaction() as c:
+            c.executemany(
+                '''DELETE FROM device_schedule WHERE event_id = ?''',
+                [(event_id,) for event_id in deletes] +
+                [(row[0],) for row in upserts])
+            c.executemany(
+                '''INSERT INTO device_schedule
+                   (timestamp, device, start_time, duration, min_duration,
+                    event_id, etag)
+                   VALUES (?, ?, ?, ?, 0, ?, ?)''',
+                [(timestamp, device, to_schedule_timestamp(start_time), duration,
+                  event_id, etag)
+                 for (event_id, etag, device, start_time, duration) in upserts])
+            self._bump_generation(c, SCHEDULE_GENERATION)
+
+    def set_tokens(self, access_token, refresh_token):
+        with self.transaction() as c:
+            c.execute("DELETE FROM access_tokens")
+            c.execute("INSERT INTO access_tokens VALUES (?, ?)",
+                    (access_token, refresh_token))
 
     def get_tokens(self):
         c = self.conn.cursor()
@@ -96,25 +995,100 @@ class DB(object):
             '''SELECT access_token, refresh_token FROM access_tokens''')
         return c.fetchone()
 
-    def get_global(self, name):
+    def get_global(self, name, default=None):
         c = self.conn.cursor()
         c.execute(
             '''SELECT value FROM globals WHERE name = ?''',
             (name,))
-        return c.fetchone()[0]
+        row = c.fetchone()
+        if row is None:
+            return default
+        return row[0]
 
     def set_global(self, name, value):
+        with self.transaction() as c:
+            c.execute(
+                '''INSERT OR REPLACE INTO globals VALUES (?, ?)''',
+                (name, value))
+
+    def queue_alert(self, key, subject, body, delay=0, repeat_interval=0):
+        """Add an alert to the outbox, due delay seconds from now.
+
+        If an alert with the same key is still unsent, this one is folded
+        into it instead: its count goes up, its body is replaced, and it is
+        brought forward if this one is due sooner (cutting short any retry
+        backoff). Either way it is held until repeat_interval seconds after
+        the last alert with its key was sent.
+        """
+        now = self.clock.time()
+        with self.transaction() as c:
+            c.execute(
+                '''SELECT MAX(sent) FROM alerts WHERE key = ?''', (key,))
+            last_sent = c.fetchone()[0]
+            due = now + delay
+            if last_sent is not None:
+                due = max(due, last_sent + repeat_interval)
+            c.execute(
+                '''UPDATE alerts
+                   SET count = count + 1, last_seen = ?, body = ?,
+                       next_attempt = MIN(next_attempt, ?)
+                   WHERE key = ? AND sent IS NULL''',
+                (now, body, due, key))
+            if c.rowcount:
+                return
+            c.execute(
+                '''INSERT INTO alerts (key, subject, body, count, first_seen,
+                       last_seen, attempts, next_attempt)
+                   VALUES (?, ?, ?, 1, ?, ?, 0, ?)''',
+                (key, subject, body, now, now, due))
+
+    def get_due_alerts(self):
+        """(id, subject, body, count, first_seen, last_seen, attempts) for
+        unsent alerts due now, oldest first."""
         c = self.conn.cursor()
-        c.execute(
-            '''DELETE FROM globals WHERE name = ?''',
-            (name,))
-        c.execute(
-            '''INSERT INTO globals VALUES (?, ?)''',
-            (name,value))
-        self.conn.commit()
+        return c.execute(
+            '''SELECT id, subject, body, count, first_seen, last_seen, attempts
+               FROM alerts WHERE sent IS NULL AND next_attempt <= ?
+               ORDER BY first_seen''',
+            (self.clock.time(),)).fetchall()
+
+    def get_next_alert_time(self):
+        """When the next unsent alert is due, or None if there are none."""
+        c = self.conn.cursor()
+        return c.execute(
+            '''SELECT MIN(next_attempt) FROM alerts WHERE sent IS NULL'''
+            ).fetchone()[0]
+
+    def mark_alerts_sent(self, ids):
+        with self.transaction() as c:
+            c.executemany(
+                '''UPDATE alerts SET sent = ? WHERE id = ?''',
+                [(self.clock.time(), identifier) for identifier in ids])
+
+    def defer_alerts(self, ids, delay):
+        """Count a failed delivery of the given alerts and try again in
+        delay seconds."""
+        with self.transaction() as c:
+            c.executemany(
+                '''UPDATE alerts
+                   SET attempts = attempts + 1, next_attempt = ?
+                   WHERE id = ?''',
+                [(self.clock.time() + delay, identifier) for identifier in ids])
+
+    def delete_sent_alerts(self, before):
+        with self.transaction() as c:
+            c.execute(
+                '''DELETE FROM alerts WHERE sent < ?''', (before,))
 
     def close(self):
-        self.conn.close()
+        """Write out buffered history and close every thread's connection.
+        Other threads must be done with the database by now."""
+        self.flush()
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
         if self.logger:
             self.logger.write_log("Closed Sqlite database.")
 
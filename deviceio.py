@@ -0,0 +1,176 @@
+"""Output backends for the daemon's devices.
+
+Every backend tracks the level it last wrote to each pin, and apply() hands
+only the pins whose level differs to write(), all at once. The daemon calls
+apply() once per loop iteration with every change its devices made, so one
+device turning off and the next turning on (a group handoff) reach the
+hardware together instead of one write apart.
+
+Within a batch, pins going high are written before pins going low. The relay
+boards the daemon drives are active low, so that is break before make: two
+devices in a group are never both on, even for the instant between writes.
+"""
+import ctypes
+import mmap
+import os
+
+
+GPIOMEM_PATH = "/dev/gpiomem"
+SPIDEV_PATH = "/dev/spidev0.0"
+
+
+class DeviceIO(object):
+    """Base class for output backends. Subclasses implement write(), and
+    setup() if pins need configuring."""
+    def __init__(self):
+        # {pin: level last written}
+        self.levels = {}
+
+    def init_output(self, pin, initial):
+        self.setup(pin, initial)
+        self.levels[pin] = initial
+
+    def setup(self, pin, initial):
+        pass
+
+    def apply(self, levels):
+        """Drive each pin in levels ({pin: 0 or 1}) to its level, writing only
+        the ones that changed, in one batch. Returns the changes."""
+        changes = dict((pin, level) for (pin, level) in levels.iteritems()
+                if self.levels.get(pin) != level)
+        if changes:
+            self.write(changes)
+            self.levels.update(changes)
+        return changes
+
+    def set_output(self, pin, output):
+        self.apply({pin: output})
+
+    def write(self, changes):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DummyDeviceIO(DeviceIO):
+    """Keeps levels in memory only."""
+    def write(self, changes):
+        pass
+
+
+class RPiGPIO(DeviceIO):
+    """Pins driven through the RPi.GPIO library."""
+    def __init__(self):
+        DeviceIO.__init__(self)
+        import RPi.GPIO
+        self.GPIO = RPi.GPIO
+        self.GPIO.setmode(self.GPIO.BCM)
+
+    def setup(self, pin, initial):
+        self.GPIO.setup(pin, self.GPIO.OUT, initial=initial)
+
+    def write(self, changes):
+        pins = sorted(changes, key=lambda pin: -changes[pin])
+        self.GPIO.output(pins, [changes[pin] for pin in pins])
+
+    def close(self):
+        self.GPIO.cleanup()
+
+
+class MmapGPIO(DeviceIO):
+    """Pins driven through the BCM283x GPIO registers, mapped from path.
+
+    A batch is at most two register writes: one to GPSET0 raising every pin
+    going high, then one to GPCLR0 lowering every pin going low. No library
+    or root is needed, only access to /dev/gpiomem. Only bank 0 (GPIO 0-31,
+    which covers the header) is supported.
+
+    For testing, path can be any file of at least BLOCK_SIZE bytes; the
+    register writes then land in it and can be read back with register().
+    """
+    BLOCK_SIZE = 4096
+    GPFSEL0 = 0x00
+    GPSET0 = 0x1c
+    GPCLR0 = 0x28
+    FUNCTION_OUTPUT = 1
+
+    def __init__(self, path=GPIOMEM_PATH):
+        DeviceIO.__init__(self)
+        fd = os.open(path, os.O_RDWR | os.O_SYNC)
+        try:
+            self.map = mmap.mmap(fd, self.BLOCK_SIZE)
+        finally:
+            os.close(fd)
+        # 32-bit words, so each register access is a single load or store
+        self.registers = (ctypes.c_uint32 * (self.BLOCK_SIZE // 4)).from_buffer(
+                self.map)
+
+    def register(self, offset):
+        return self.registers[offset // 4]
+
+    def set_register(self, offset, value):
+        self.registers[offset // 4] = value
+
+    def setup(self, pin, initial):
+        if not 0 <= pin < 32:
+            raise ValueError("GPIO %d is not in bank 0" % pin)
+        # Set the level before making the pin an output, so it never glitches
+        self.write({pin: initial})
+        offset = self.GPFSEL0 + 4*(pin // 10)
+        shift = 3*(pin % 10)
+        self.set_register(offset, (self.register(offset) & ~(7 << shift)) |
+                (self.FUNCTION_OUTPUT << shift))
+
+    def write(self, changes):
+        high = low = 0
+        for (pin, level) in changes.iteritems():
+            if level:
+                high |= 1 << pin
+            else:
+                low |= 1 << pin
+        if high:
+            self.set_register(self.GPSET0, high)
+        if low:
+            self.set_register(self.GPCLR0, low)
+
+    def close(self):
+        del self.registers
+        self.map.close()
+
+
+class ShiftRegisterIO(DeviceIO):
+    """Outputs on a chain of 74HC595 shift registers, written over SPI.
+
+    Pin n is output n % 8 of chip n // 8, counting from the one wired to the
+    Pi. Wire the latch to the chip select, so every write shifts out the
+    whole chain and the new levels appear on all outputs at the same moment.
+    Three GPIO pins then drive 8*chips outputs.
+
+    For testing, path can be an ordinary file; each write appends the bytes
+    shifted out, so the file holds every state the chain was latched in.
+    """
+    def __init__(self, chips, path=SPIDEV_PATH):
+        DeviceIO.__init__(self)
+        self.chips = chips
+        # Outputs no device uses are left high: off, on active low boards
+        self.state = bytearray([0xff] * chips)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+
+    def setup(self, pin, initial):
+        if not 0 <= pin < 8*self.chips:
+            raise ValueError("Pin %d is past the end of %d shift registers" % (
+                pin, self.chips))
+        self.write({pin: initial})
+
+    def write(self, changes):
+        for (pin, level) in changes.iteritems():
+            if level:
+                self.state[pin // 8] |= 1 << (pin % 8)
+            else:
+                self.state[pin // 8] &= ~(1 << (pin % 8)) & 0xff
+        # The first byte shifted out ends up in the last chip
+        os.write(self.fd, bytes(self.state[::-1]))
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,308 @@
+import Queue
+import datetime
+import httplib
+import json
+import socket
+import threading
+import time
+import traceback
+import urllib
+
+import log
+import secrets
+
+
+class SyncError(Exception):
+    """A request to Google failed even after retrying."""
+    pass
+
+
+class TokenError(Exception):
+    """Google rejected our access token."""
+    pass
+
+
+def parse_time(value):
+    """Parse a calendar dateTime as a naive datetime in its own time zone."""
+    return datetime.datetime.strptime(value[:-6], "%Y-%m-%dT%H:%M:%S")
+
+
+class CalendarSync(object):
+    """Syncs device schedules from Google Calendar on a background thread.
+
+    Network calls can take arbitrarily long, so they never run on the control
+    loop. The caller starts out with the schedules stored by earlier syncs
+    (DB.get_calendar_schedules) and the first sync only revalidates them.
+    Whenever a sync changes anything, the complete {device_id: [schedule,
+    ...]} dict is handed to publish() in one piece; the caller swaps it in.
+    Unrecoverable errors are passed to fail() as a string, and syncs that
+    failed but will be retried to warn(), if given.
+
+    Event instances in a window around now are fetched in a single paged
+    list. The list's sync token is kept in globals so that later syncs only
+    transfer events that changed, and unchanged instances are recognized by
+    their ETags and not rewritten.
+
+    The callbacks are invoked on the sync thread, which shares the caller's
+    db.DB (and so gets a connection of its own).
+    """
+    api_host = "www.googleapis.com"
+    auth_host = "accounts.google.com"
+    connection_class = httplib.HTTPSConnection
+
+    # Seconds to wait for any one HTTP request
+    timeout = 20
+    # Retries per request, starting backoff_delay seconds apart and doubling
+    retries = 3
+    backoff_delay = 2
+
+    # Event instances within this window around now are synced
+    lookbehind = datetime.timedelta(1)
+    lookahead = datetime.timedelta(7)
+
+    def __init__(self, database, logger, publish, fail, interval=5*60,
+                 warn=None):
+        self.database = database
+        self.logger = logger
+        self.publish = publish
+        self.fail = fail
+        self.warn = warn
+        self.interval = interval
+
+        self.error_count = 0
+        # The first sync after starting ignores the interval
+        self.revalidated = False
+
+        self.connections = {}
+        self.round_trips = 0
+        self.bytes_received = 0
+
+        self.requests = Queue.Queue()
+        self.pending = False
+        self.thread = threading.Thread(target=self.run, name="gcal")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def request_sync(self):
+        """Ask the sync thread to sync if it is due. Never blocks."""
+        if not self.pending:
+            self.pending = True
+            self.requests.put(True)
+
+    def stop(self):
+        # Don't wait for the thread; it may be stuck on the network
+        self.requests.put(None)
+
+    def run(self):
+        try:
+            while self.requests.get():
+                self.pending = False
+                try:
+                    schedules = self.update(self.database)
+                except SyncError, e:
+                    self.logger.write_log(
+                        "### Calendar sync failed: %s. Trying again later." % e,
+                        log.WARNING)
+                    if self.warn:
+                        self.warn(str(e))
+                    continue
+                except Exception:
+                    self.fail(traceback.format_exc())
+                    return
+                if schedules is not None:
+                    self.publish(schedules)
+        finally:
+            for host in self.connections.keys():
+                self.close_connection(host)
+
+    def request(self, host, method, path, body=None, headers={}):
+        """Make an HTTP request and parse any JSON response.
+
+        Connections are kept open between requests. Connection failures,
+        timeouts and server errors are retried with exponential backoff;
+        SyncError is raised when retries run out.
+
+        Returns (status, ETag header, parsed body or None).
+        """
+        delay = self.backoff_delay
+        for attempt in xrange(self.retries + 1):
+            try:
+                conn = self.connections.get(host)
+                if conn is None:
+                    conn = self.connection_class(host, timeout=self.timeout)
+                    self.connections[host] = conn
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                self.round_trips += 1
+                self.bytes_received += len(data)
+                if response.status < 500:
+                    return (response.status, response.getheader("ETag"),
+                            json.loads(data) if data else None)
+                error = "HTTP %d from %s" % (response.status, host)
+            except (httplib.HTTPException, socket.error, ValueError), e:
+                error = "%s from %s" % (e, host)
+                self.close_connection(host)
+
+            if attempt == self.retries:
+                raise SyncError(error)
+            self.logger.write_log("### %s; retrying in %d seconds." % (
+                error, delay), log.WARNING)
+            time.sleep(delay)
+            delay *= 2
+
+    def close_connection(self, host):
+        conn = self.connections.pop(host, None)
+        if conn:
+            conn.close()
+
+    def refresh_token(self, database, refresh_token, error):
+        self.error_count += 1
+        if self.error_count > 3:
+            # Send an email and shut down.
+            raise Exception("Failed to load calendar 3 times in a row. Giving up.")
+
+        self.logger.write_log("### Error getting calendar, attempting to refresh token:\n%s" % error, log.WARNING)
+        try:
+            (status, etag, res) = self.request(self.auth_host, "POST", "/o/oauth2/token",
+                "client_id=%s&client_secret=%s&refresh_token=%s&grant_type=refresh_token" % (
+                    secrets.OAUTH_CLIENT_ID, secrets.OAUTH_SECRET, refresh_token),
+                {"Content-Type": "application/x-www-form-urlencoded"})
+        except SyncError, e:
+            self.logger.write_log("### Error refreshing token: %s. Trying again..." % e, log.WARNING)
+            return
+        if res and "access_token" in res:
+            database.set_tokens(res["access_token"], refresh_token)
+
+    def fetch_events(self, database, access_token, sync_token):
+        """Fetch every page of the event list.
+
+        With a sync token only events changed since it was issued are
+        returned; otherwise all event instances in the sync window are.
+        Returns (items, next sync token, ETag), or None if the sync token
+        has expired. Raises TokenError if the access token was rejected.
+        """
+        params = {
+            "access_token": access_token,
+            "singleEvents": "true",
+            "maxResults": 250,
+        }
+        headers = {}
+        if sync_token:
+            params["syncToken"] = sync_token
+            etag = database.get_global("gcetag")
+            if etag:
+                headers["If-None-Match"] = etag
+        else:
+            now = datetime.datetime.utcnow()
+            params["timeMin"] = (now - self.lookbehind).isoformat("T") + "Z"
+            params["timeMax"] = (now + self.lookahead).isoformat("T") + "Z"
+
+        items = []
+        while True:
+            (status, etag, res) = self.request(self.api_host, "GET",
+                "/calendar/v3/calendars/%s/events?%s" % (
+                    urllib.quote(secrets.CALENDAR_ID), urllib.urlencode(params)),
+                headers=headers)
+            if status == 304:
+                # Nothing has changed since the last sync
+                return ([], sync_token, headers["If-None-Match"])
+            if status == 410:
+                return None
+            if res is None or "error" in res:
+                raise TokenError(res["error"]["message"] if res else
+                        "HTTP %d" % status)
+
+            items.extend(res.get("items", []))
+            if "nextPageToken" not in res:
+                return (items, res.get("nextSyncToken"), etag)
+            params["pageToken"] = res["nextPageToken"]
+            headers = {}
+
+    def update(self, database):
+        """Sync if it is due; returns the new schedules or None."""
+        last_update = int(database.get_global("gcupdatetime", "0"))
+        if (self.revalidated and
+                int(time.time()) - last_update < self.interval):
+            return None
+
+        (access_token, refresh_token) = database.get_tokens()
+        self.round_trips = 0
+        self.bytes_received = 0
+
+        # Instances that enter the window as time passes don't show up as
+        # changes, so start over with a full sync well before it runs out.
+        sync_token = database.get_global("gcsynctoken")
+        window_end = int(database.get_global("gcwindowend", "0"))
+        if window_end - time.time() < self.lookahead.total_seconds() / 2:
+            sync_token = None
+
+        try:
+            result = self.fetch_events(database, access_token, sync_token)
+            if result is None:
+                self.logger.write_log("Calendar sync token expired; starting over.")
+                sync_token = None
+                result = self.fetch_events(database, access_token, None)
+        except TokenError, e:
+            self.refresh_token(database, refresh_token, e)
+            return None
+
+        self.error_count = 0
+        (items, next_sync_token, etag) = result
+
+        window_start = datetime.datetime.now() - self.lookbehind
+        window_end = datetime.datetime.now() + self.lookahead
+        known = database.get_calendar_etags()
+        upserts = []
+        deletes = set()
+        seen = set()
+        for event in items:
+            event_id = event["id"]
+            seen.add(event_id)
+            summary = event.get("summary", ":").split(":")
+            start = event.get("start", {}).get("dateTime")
+            end = event.get("end", {}).get("dateTime")
+            if (event.get("status", "") == "cancelled" or
+                    summary[0] != "device" or not start or not end):
+                deletes.add(event_id)
+                continue
+
+            start_time = parse_time(start)
+            end_time = parse_time(end)
+            if end_time < window_start or start_time > window_end:
+                deletes.add(event_id)
+                continue
+            if known.get(event_id) == event.get("etag"):
+                continue
+
+            device_id = int(summary[1])
+            duration = (end_time - start_time).total_seconds()
+            self.logger.write_log("Device %d runs at %s for up to %d seconds" % (device_id, start_time, duration), log.DEBUG)
+            upserts.append((event_id, event.get("etag"), device_id,
+                start_time, duration))
+
+        if sync_token is None:
+            # A full sync lists everything, so anything missing is gone
+            deletes.update(set(known) - seen)
+        deletes &= set(known)
+
+        if upserts or deletes:
+            database.update_calendar_schedule(upserts, list(deletes))
+
+        database.set_global("gcsynctoken", next_sync_token or "")
+        database.set_global("gcetag", etag or "")
+        if sync_token is None:
+            database.set_global("gcwindowend", str(int(
+                time.time() + self.lookahead.total_seconds())))
+        database.set_global("gcupdatetime", str(int(time.time())))
+
+        self.logger.write_log(
+            "Synced Google calendar: %d changes in %d requests, %d bytes." % (
+                len(upserts) + len(deletes), self.round_trips,
+                self.bytes_received))
+        self.revalidated = True
+        if not upserts and not deletes:
+            return None
+        return database.get_calendar_schedules()
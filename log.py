@@ -0,0 +1,122 @@
+import Queue
+import collections
+import datetime
+import gzip
+import os
+import shutil
+import threading
+
+from clock import SystemClock
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+
+class Logger(object):
+    """Writes log lines to a file from a background thread.
+
+    write_log() only appends to a bounded queue, so the control loop never
+    waits on the SD card; if the writer falls behind, lines are dropped and
+    counted rather than blocking. The writer lets the file buffer fill and
+    flushes it every flush_interval seconds, or immediately for errors and
+    on close. Once the file reaches max_bytes it is gzipped to
+    <filename>.1.gz, shifting older ones up to <filename>.<backups>.gz.
+
+    The last tail_size lines of every level, including those below the
+    logging level, are kept in memory for error reports; see tail().
+    """
+    def __init__(self, filename, level=INFO, max_bytes=1024*1024, backups=5,
+                 queue_size=1000, flush_interval=5, tail_size=100,
+                 clock=None):
+        self.filename = filename
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.clock = clock or SystemClock()
+
+        self.recent = collections.deque(maxlen=tail_size)
+        self.dropped = 0
+
+        self.f = open(filename, 'a')
+        self.queue = Queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.run, name="log")
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.write_log("Logging started.")
+
+    def write_log(self, msg, level=INFO):
+        record = (self.clock.time(), level, msg)
+        self.recent.append(record)
+        if level < self.level:
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def format(self, record):
+        (timestamp, level, msg) = record
+        if level == INFO:
+            return "%s: %s\n" % (datetime.datetime.fromtimestamp(timestamp), msg)
+        return "%s: %s: %s\n" % (datetime.datetime.fromtimestamp(timestamp),
+                LEVEL_NAMES[level], msg)
+
+    def tail(self):
+        """The most recent lines, oldest first, as one string."""
+        return "".join(self.format(record) for record in list(self.recent))
+
+    def run(self):
+        dirty = False
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except Queue.Empty:
+                if dirty:
+                    self.f.flush()
+                    dirty = False
+                continue
+            if record is None:
+                break
+
+            if self.dropped:
+                dropped = self.dropped
+                self.dropped = 0
+                self.f.write(self.format((record[0], WARNING,
+                    "%d log lines dropped; the writer fell behind." % dropped)))
+            self.f.write(self.format(record))
+            dirty = True
+            if record[1] >= ERROR:
+                self.f.flush()
+                dirty = False
+            if self.f.tell() >= self.max_bytes:
+                self.rotate()
+                dirty = False
+        self.f.close()
+
+    def rotate(self):
+        self.f.close()
+        for index in xrange(self.backups - 1, 0, -1):
+            source = "%s.%d.gz" % (self.filename, index)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d.gz" % (self.filename, index + 1))
+        if self.backups > 0:
+            with open(self.filename, 'rb') as source:
+                target = gzip.open("%s.1.gz" % self.filename, 'wb')
+                try:
+                    shutil.copyfileobj(source, target)
+                finally:
+                    target.close()
+        self.f = open(self.filename, 'w')
+
+    def close(self):
+        """Write out everything queued and stop the writer."""
+        self.write_log("Logging ended.")
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,163 @@
+import BaseHTTPServer
+import bisect
+import functools
+import threading
+import timeit
+
+
+# Upper bounds in seconds, from 10 microseconds to a minute
+TIME_BUCKETS = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03,
+                0.1, 0.3, 1, 3, 10, 30, 60)
+
+
+class Histogram(object):
+    """Counts observations in fixed buckets, Prometheus style.
+
+    observe() is a bisect and two additions, so it is cheap enough for the
+    hot path. Buckets are stored non-cumulatively and summed on render.
+    Updates aren't locked, so observations racing from two threads can
+    occasionally be lost; that is fine for monitoring.
+    """
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self, function):
+        """Decorate function so that each call's duration is observed."""
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(timeit.default_timer() - start)
+        return timed
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        counts = list(self.counts)
+        for (bound, count) in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            lines.append("%s_bucket%s %d" % (
+                name, format_labels(labels + [("le", str(bound))]), total))
+        lines.append("%s_sum%s %r" % (name, format_labels(labels), self.sum))
+        lines.append("%s_count%s %d" % (name, format_labels(labels), total))
+        return lines
+
+
+class Gauge(object):
+    """A value that is set, or read from a function when rendered."""
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, labels):
+        value = self.function() if self.function else self.value
+        return ["%s%s %r" % (name, format_labels(labels), value)]
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+            for (key, value) in labels)
+
+
+class Family(object):
+    """A named metric, with one child per combination of label values."""
+    def __init__(self, name, help, kind, factory, label_names=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.factory = factory
+        self.label_names = label_names
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for (values, child) in sorted(self.children.items()):
+            lines.extend(child.render(
+                self.name, list(zip(self.label_names, values))))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.families = []
+
+    def histogram(self, name, help, label_names=(), buckets=TIME_BUCKETS):
+        family = Family(name, help, "histogram",
+                lambda: Histogram(buckets), label_names)
+        self.families.append(family)
+        return family if label_names else family.labels()
+
+    def gauge(self, name, help, function=None):
+        family = Family(name, help, "gauge", lambda: Gauge(function))
+        self.families.append(family)
+        return family.labels()
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+def instrument(cls, family, methods=None):
+    """Time calls to cls's public methods (or the named ones) into family,
+    labeled by method name."""
+    if methods is None:
+        methods = [name for (name, value) in vars(cls).items()
+                if callable(value) and not name.startswith("_")]
+    for name in methods:
+        setattr(cls, name, family.labels(name).time(vars(cls)[name]))
+
+
+class MetricsServer(object):
+    """Serves a registry at /metrics over HTTP on a background thread."""
+    def __init__(self, registry, port, host="127.0.0.1"):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                        "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                name="metrics")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,14 +1,32 @@
 #!/usr/bin/python
 
-import datetime
-import httplib
+import alerts
+import argparse
+import bisect
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
 import json
+import os
+import select
 import signal
+import socket
+import sqlite3
 import sys
 import time
+import timeit
 import traceback
 
-import db
+import clock as clock_module
+import dataservice
+import db as db_module
+import deviceio
+import gcal
+import log
+import metrics
+import schedules
 import secrets
 
 # Set a flag if a graceful exit is requested
@@ -19,104 +37,534 @@ def sigterm_handler(_signo, _stack_frame):
 
 signal.signal(signal.SIGTERM, sigterm_handler)
 
-def send_email(subject, body):
-    header  = 'From: %s\n' % secrets.FROM_ADDRESS
-    header += 'To: %s\n' % secrets.EMAIL_ADDRESS
-    header += 'Subject: %s\n\n' % subject
-    message = header + body
-
-    import smtplib
-    server = smtplib.SMTP('smtp.gmail.com', 587)
-    server.starttls()
-    server.login(secrets.EMAIL_ADDRESS, secrets.EMAIL_PASSWORD)
-    server.sendmail(secrets.FROM_ADDRESS, secrets.EMAIL_ADDRESS, message)
+DB_FILENAME = '/var/lib/pi-timer/db.sqlite'
+LOG_FILENAME = '/var/log/pi-timer.log'
+# Lines below this level (e.g. log.DEBUG for every pin change) are not written
+LOG_LEVEL = log.INFO
+
+# Longest we will sleep without feeding the watchdog
+WATCHDOG_INTERVAL = 10
+# How often to check for changes to devices and schedules. This is nearly free
+# while nothing changes (see db.DB.get_generation).
+DEVICE_REFRESH_INTERVAL = 10
+# How often to ask the calendar sync thread whether a sync is due
+CALENDAR_SYNC_INTERVAL = 60
+# How often to look for history past its retention period, and how soon to
+# continue while there is a backlog of it
+COMPACT_INTERVAL = 10*60
+COMPACT_BACKLOG_INTERVAL = 1
+# Device timers run on the monotonic clock, but schedules are in wall time.
+# The Pi has no RTC, so NTP steps the wall clock, often by hours, some time
+# after boot; when it moves this many seconds against the monotonic clock,
+# every device is re-evaluated.
+CLOCK_STEP_THRESHOLD = 5
+# Default for --durability: whether every history row is synced to disk as
+# it is logged (DURABILITY_STRICT) or only committed, with the log synced in
+# bulk to spare the SD card (DURABILITY_BATCHED). Either way, the main loop
+# commits each iteration's state changes before it sleeps.
+HISTORY_DURABILITY = db_module.DURABILITY_BATCHED
+# Seconds to wait on another process's database write. Kept well under the
+# watchdog timeout; history that can't be written in time is retried later.
+DB_BUSY_TIMEOUT = 2
+# The hardware watchdog reboots the Pi if not fed for this long
+WATCHDOG_TIMEOUT = 15
+# The watchdog is only armed once the daemon has run this long, so that a bug
+# at startup can't get us into a watchdog reboot loop. Devices are controlled
+# from the start.
+WATCHDOG_ARM_DELAY = 60
+# Local port serving /metrics in Prometheus text format; 0 to disable
+METRICS_PORT = 9274
+# Local port serving dashboard data (see dataservice.py); 0 to disable
+DATA_PORT = 9275
+# Group slots shared with other nodes are leased for this long, renewed every
+# GROUP_LEASE_RENEW_INTERVAL; a node that stops renewing loses its slots.
+GROUP_LEASE_TTL = 60
+GROUP_LEASE_RENEW_INTERVAL = 20
+# How often a device waiting on a group shared with other nodes asks again,
+# since slots freed there can't wake it
+GROUP_LEASE_POLL_INTERVAL = 5
+# Where alert emails are sent from (see alerts.py)
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 587
+# Alerts other than crashes wait this long before being emailed, so that
+# others raised meanwhile go out in the same message
+ALERT_BATCH_DELAY = 5*60
+# Each kind of alert is emailed at most this often; repeats in between are
+# counted and sent together
+ALERT_REPEAT_INTERVAL = 60*60
+# Alerts that can't be queued in the database (say, because the database is
+# what failed) are appended to this file next to the log, one JSON
+# [key, subject, body] per line, and queued at the next start
+ALERT_SPOOL_SUFFIX = ".alerts"
+
+registry = metrics.Registry()
+DEVICE_UPDATE_SECONDS = registry.histogram("pitimer_device_update_seconds",
+    "Time taken to apply a device's schedule.")
+SHOULD_ENABLE_SECONDS = registry.histogram("pitimer_should_enable_seconds",
+    "Time taken by schedulers to decide whether a device should be on.")
+DB_CALL_SECONDS = registry.histogram("pitimer_db_call_seconds",
+    "Time taken by db.DB methods.", ["method"])
+CALENDAR_CALL_SECONDS = registry.histogram("pitimer_calendar_call_seconds",
+    "Time taken by calendar syncs and each HTTP request they make.", ["method"])
+TIMER_LAG_SECONDS = registry.histogram("pitimer_timer_lag_seconds",
+    "How long after they were due timers (e.g. device transitions) ran.")
+IO_APPLY_SECONDS = registry.histogram("pitimer_io_apply_seconds",
+    "Time taken to write a batch of pin changes to the output backend.")
+WATCHDOG_SLACK_SECONDS = registry.histogram("pitimer_watchdog_slack_seconds",
+    "Time left before the watchdog would have fired, at each keep-alive.",
+    buckets=(0, 1, 2, 5, 10, WATCHDOG_TIMEOUT))
+HISTORY_ROWS = registry.gauge("pitimer_history_rows",
+    "Rows in device_history, as of the last compaction check.")
+DB_BYTES = registry.gauge("pitimer_db_bytes",
+    "Size of the database file, not counting the WAL.",
+    lambda: os.path.getsize(args.db))
+
+metrics.instrument(db_module.DB, DB_CALL_SECONDS)
+metrics.instrument(gcal.CalendarSync, CALENDAR_CALL_SECONDS,
+    ["request", "update"])
+
+def alert(key, subject, body, delay=ALERT_BATCH_DELAY):
+    """Queue an email for the alert sender; repeats of a key are folded
+    together (see db.DB.queue_alert). Safe from any thread, and never waits
+    on the network."""
+    if alert_sender is None:
+        return
+    try:
+        db.queue_alert(key, subject, body, delay, ALERT_REPEAT_INTERVAL)
+    except sqlite3.Error:
+        spool = args.log + ALERT_SPOOL_SUFFIX
+        logger.write_log("### Couldn't queue alert \"%s\"; spooling it to %s "
+                "for the next start:\n%s" % (subject, spool,
+                    traceback.format_exc()), log.ERROR)
+        try:
+            with open(spool, "a") as f:
+                f.write(json.dumps([key, subject, body]) + "\n")
+        except IOError, e:
+            logger.write_log("### Couldn't spool alert \"%s\": %s\n%s" % (
+                subject, e, body), log.ERROR)
+        return
+    alert_sender.notify()
+
+
+def queue_spooled_alerts():
+    """Queue the alerts earlier runs couldn't, now that the database is
+    open, and remove the spool file."""
+    spool = args.log + ALERT_SPOOL_SUFFIX
+    try:
+        with open(spool) as f:
+            lines = f.readlines()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            logger.write_log("### Couldn't read spooled alerts: %s" % e,
+                    log.WARNING)
+        return
+    for line in lines:
+        try:
+            (key, subject, body) = json.loads(line)
+        except ValueError:
+            # Cut short by a crash while it was written
+            continue
+        db.queue_alert(key, subject, body, 0, ALERT_REPEAT_INTERVAL)
+    os.remove(spool)
+    logger.write_log("Queued %d spooled alert(s)." % len(lines))
 
 try:
-    import RPi.GPIO as GPIO
+    import RPi.GPIO
     enable_rpio = True
 except ImportError:
     enable_rpio = False
 
-class Logger(object):
-    def __init__(self):
-        self.f = open('/var/log/pi-timer.log', 'a')
-        self.write_log("Logging started.")
-
-    def write_log(self, msg):
-        self.f.write("%s: %s\n" % (datetime.datetime.now(), msg))
-        self.f.flush()
 
-    def close(self):
-        self.write_log("Logging ended.")
-        self.f.close()
+def no_watchdog():
+    pass
 
 
 if enable_rpio:
-    class DeviceIO(object):
-        """IO controller for Raspberry Pi."""
-        def __init__(self):
-            logger.write_log("Initializing GPIO.")
-            GPIO.setmode(GPIO.BCM)
-
-        def init_output(self, pin):
-            GPIO.setup(pin, GPIO.OUT)
-
-        def set_output(self, pin, output):
-            logger.write_log("Setting pin %d to %d" % (pin, output))
-            GPIO.output(pin, output)
-
-        def close(self):
-            logger.write_log("Cleaning up GPIO.")
-            GPIO.cleanup()
-
     import watchdogdev
     watchdog = None
 
     def init_watchdog():
         global watchdog
-        # Wait for a full minute, since this is a startup task and if there
-        # is a bug we can get into a watchdog shutdown loop
-        logger.write_log("Waiting for 60 seconds...")
-        time.sleep(60)
-
         logger.write_log("Enabling watchdog!")
         watchdog = watchdogdev.watchdog("/dev/watchdog")
 
     def keep_alive():
-        global watchdog
-        watchdog.keep_alive()
+        if watchdog:
+            watchdog.keep_alive()
 
     def close_watchdog():
-        watchdog.magic_close()
+        if watchdog:
+            watchdog.magic_close()
 else:
-    class DeviceIO(object):
-        """Dummy IO controller."""
-        def __init__(self):
-            pass
-
-        def init_output(self, pin):
-            pass
+    init_watchdog = keep_alive = close_watchdog = no_watchdog
+
+
+def open_io():
+    """The output backend chosen by --io."""
+    backend = args.io
+    if args.simulate or backend == "auto" and not enable_rpio:
+        backend = "dummy"
+    elif backend == "auto":
+        backend = "rpi"
+    logger.write_log("Initializing %s outputs." % backend)
+    if backend == "rpi":
+        return deviceio.RPiGPIO()
+    if backend == "mmap":
+        return deviceio.MmapGPIO(args.io_path or deviceio.GPIOMEM_PATH)
+    if backend == "shift":
+        return deviceio.ShiftRegisterIO(args.shift_chips,
+                args.io_path or deviceio.SPIDEV_PATH)
+    return deviceio.DummyDeviceIO()
+
+
+def apply_outputs():
+    """Write the pin levels devices changed to since the last call, in one
+    batch, so that devices switching together (e.g. a group handoff) switch
+    at the same moment."""
+    if not pending_outputs:
+        return
+    start = timeit.default_timer()
+    changes = io.apply(pending_outputs)
+    IO_APPLY_SECONDS.observe(timeit.default_timer() - start)
+    pending_outputs.clear()
+    if changes and logger.level <= log.DEBUG:
+        logger.write_log("Set pins %s" % ", ".join("%d to %d" % change
+                for change in sorted(changes.iteritems())), log.DEBUG)
+
+
+class RuntimeLedger(object):
+    """In-memory record of when a device was on, for fast runtime queries.
+
+    Completed on intervals are kept sorted by end time along with a running
+    total of their durations, so the time spent on since any moment can be
+    answered with a single bisect instead of a walk over the history.
+    """
+    # How much history to keep; must cover the longest schedule window
+    horizon = 2*24*60*60
 
-        def set_output(self, pin, output):
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        # totals[i] is the summed duration of intervals 0..i inclusive
+        self.totals = []
+        self.on_since = None
+
+    def seed(self, history):
+        """Load (timestamp, enabled) rows, oldest first."""
+        for (timestamp, enabled) in history:
+            if enabled:
+                self.record_on(timestamp)
+            else:
+                self.record_off(timestamp)
+
+    def record_on(self, timestamp):
+        if self.on_since is None:
+            self.on_since = timestamp
+
+    def record_off(self, timestamp):
+        if self.on_since is None:
+            return
+        total = self.totals[-1] if self.totals else 0
+        self.starts.append(self.on_since)
+        self.ends.append(timestamp)
+        self.totals.append(total + timestamp - self.on_since)
+        self.on_since = None
+        self.prune(timestamp - RuntimeLedger.horizon)
+
+    def prune(self, before):
+        # Totals stay valid when the oldest intervals are dropped since only
+        # differences between them are ever used.
+        count = bisect.bisect_right(self.ends, before)
+        if count:
+            del self.starts[:count]
+            del self.ends[:count]
+            del self.totals[:count]
+
+    def runs_since(self, since):
+        """Number of times the device turned on at or after since."""
+        runs = len(self.starts) - bisect.bisect_left(self.starts, since)
+        if self.on_since is not None and self.on_since >= since:
+            runs += 1
+        return runs
+
+    def seconds_on_since(self, since, now):
+        """Total seconds the device has been on between since and now."""
+        total = 0
+        index = bisect.bisect_right(self.ends, since)
+        if index < len(self.ends):
+            total = self.totals[-1] - (
+                self.totals[index - 1] if index > 0 else 0)
+            # The first interval may have started before the cutoff
+            if self.starts[index] < since:
+                total -= since - self.starts[index]
+        if self.on_since is not None:
+            total += now - max(self.on_since, since)
+        return total
+
+
+class TimerQueue(object):
+    """Runs callbacks when they come due on the clock's monotonic time.
+
+    Every callback is scheduled under a key; scheduling the same key again
+    replaces the earlier entry. wait() sleeps until the next entry is due, a
+    signal arrives or wake() is called.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        # Callbacks handed over from other threads
+        self.posted = collections.deque()
+
+        (self.wake_fd, self.wake_write_fd) = os.pipe()
+        for fd in (self.wake_fd, self.wake_write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # Signal handlers only run between bytecodes, so also have signals
+        # write to the pipe to interrupt a pending select()
+        signal.set_wakeup_fd(self.wake_write_fd)
+
+    def schedule(self, key, delay, callback, *args):
+        self.cancel(key)
+        entry = [self.clock.monotonic() + delay, next(self.counter), key, callback, args]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def post(self, callback, *args):
+        """Run callback on the loop's thread as soon as possible.
+
+        This is the only method that is safe to call from other threads.
+        """
+        self.posted.append((callback, args))
+        self.wake()
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            # Leave it in the heap; it is skipped when it reaches the top
+            entry[3] = None
+
+    def next_due(self):
+        while self.heap and self.heap[0][3] is None:
+            heapq.heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def run_due(self):
+        while self.posted:
+            (callback, args) = self.posted.popleft()
+            callback(*args)
+        while True:
+            due = self.next_due()
+            if due is None or due > self.clock.monotonic():
+                return
+            entry = heapq.heappop(self.heap)
+            del self.entries[entry[2]]
+            TIMER_LAG_SECONDS.observe(self.clock.monotonic() - entry[0])
+            entry[3](*entry[4])
+
+    def wake(self):
+        try:
+            os.write(self.wake_write_fd, "\0")
+        except OSError:
+            # The pipe is full, so a wakeup is already pending
             pass
 
-        def close(self):
+    def wait(self, max_delay):
+        delay = max_delay
+        due = self.next_due()
+        if self.posted:
+            delay = 0
+        elif due is not None:
+            delay = min(delay, due - self.clock.monotonic())
+        if delay > 0:
+            try:
+                self.clock.select([self.wake_fd], delay)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        try:
+            while os.read(self.wake_fd, 4096):
+                pass
+        except OSError:
             pass
 
-    def init_watchdog():
-        pass
-
-    def keep_alive():
-        pass
-
-    def close_watchdog():
-        pass
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        os.close(self.wake_fd)
+        os.close(self.wake_write_fd)
+
+
+class GroupArbiter(object):
+    """Decides which devices in a group may be on when they share capacity.
+
+    Each group allows a number of devices on at once (e.g. zones sharing a
+    water main). Devices that want to run while their group is full wait in
+    a queue ordered by the end of their scheduled window, then by how long
+    they still need to run, so the runs closest to being missed go first.
+    When a device turns off, its slot goes to the head of the queue right
+    away and that device is woken to turn on.
+
+    Groups with devices on other nodes (shared groups) keep the queue in the
+    database instead, as leases (see db.DB.request_group_slot). Waiting
+    devices there ask again every GROUP_LEASE_POLL_INTERVAL, and the slots
+    this node holds are renewed by renew_leases(). If the database can't be
+    reached, no new slots are granted in shared groups.
+    """
+    def __init__(self):
+        self.capacities = {}
+        self.shared = set()
+        # {group: set of device IDs holding a slot}
+        self.holders = {}
+        # {group: {device ID: (deadline, remaining seconds)}}
+        self.waiting = {}
+
+    def set_groups(self, capacities, shared):
+        """Set every group's capacity, and which groups are shared."""
+        self.capacities = capacities
+        for group in self.shared ^ shared:
+            self.reset(group)
+        self.shared = shared
+        for group in self.waiting.keys():
+            self.grant(group)
+
+    def reset(self, group):
+        """Forget a group's slots and queue, as when it starts or stops
+        being shared, and have its devices ask again."""
+        for identifier in (list(self.holders.pop(group, ())) +
+                list(self.waiting.pop(group, {}))):
+            if group in self.shared:
+                self.release_lease(group, identifier)
+            if identifier in devices:
+                timers.schedule(("device", identifier), 0, update_device,
+                        devices[identifier])
+
+    def capacity(self, group):
+        return self.capacities.get(group, db_module.DEFAULT_GROUP_CAPACITY)
+
+    def resume(self, device):
+        """Give a device found on at startup back its slot, if its group has
+        room, so that it isn't switched off for whichever device in the
+        group happens to update first. In a shared group, its lease is
+        requested as the most urgent in the queue."""
+        holders = self.holders.setdefault(device.group, set())
+        if device.group in self.shared:
+            self.waiting.setdefault(device.group, {})[device.identifier] = (
+                clock.time(), 0)
+            self.request_lease(device.group, device.identifier)
+        elif len(holders) < self.capacity(device.group):
+            holders.add(device.identifier)
+
+    def request(self, device, deadline, remaining):
+        """Whether device may turn on now; if not, it is queued."""
+        holders = self.holders.setdefault(device.group, set())
+        if device.identifier in holders:
+            return True
+        self.waiting.setdefault(device.group, {})[device.identifier] = (
+            deadline, remaining)
+        if device.group in self.shared:
+            self.request_lease(device.group, device.identifier)
+        else:
+            self.grant(device.group, device.identifier)
+        return device.identifier in holders
+
+    def request_lease(self, group, identifier):
+        (deadline, remaining) = self.waiting[group][identifier]
+        try:
+            granted = db.request_group_slot(group, identifier, args.node,
+                    self.capacity(group), deadline, remaining,
+                    GROUP_LEASE_TTL)
+        except sqlite3.OperationalError, e:
+            if not db_module.is_locked(e):
+                raise
+            logger.write_log("### Couldn't ask for a slot in group %d: %s" % (
+                group, e), log.WARNING)
+            return
+        if granted:
+            del self.waiting[group][identifier]
+            self.holders[group].add(identifier)
+
+    def release(self, device):
+        """device no longer wants to be on; pass its slot on."""
+        waiting = self.waiting.get(device.group, {})
+        holders = self.holders.get(device.group, set())
+        if (device.identifier not in waiting and
+                device.identifier not in holders):
+            return
+        waiting.pop(device.identifier, None)
+        if device.group in self.shared:
+            self.release_lease(device.group, device.identifier)
+        if device.identifier in holders:
+            holders.remove(device.identifier)
+            self.grant(device.group)
+
+    def release_lease(self, group, identifier):
+        try:
+            db.release_group_slot(group, identifier)
+        except sqlite3.OperationalError, e:
+            if not db_module.is_locked(e):
+                raise
+            # renew_leases drops it next time
+            logger.write_log("### Couldn't release a slot in group %d: %s" % (
+                group, e), log.WARNING)
+
+    def renew_leases(self):
+        """Keep this node's shared slots and places in queues."""
+        timers.schedule("leases", GROUP_LEASE_RENEW_INTERVAL,
+                self.renew_leases)
+        identifiers = set()
+        for group in self.shared:
+            identifiers.update(self.holders.get(group, ()))
+            identifiers.update(self.waiting.get(group, ()))
+        try:
+            db.renew_group_leases(args.node, identifiers, GROUP_LEASE_TTL)
+        except sqlite3.OperationalError, e:
+            if not db_module.is_locked(e):
+                raise
+            logger.write_log("### Couldn't renew group leases: %s" % e,
+                    log.WARNING)
+
+    def waiting_on_other_nodes(self, device):
+        """Whether device is queued behind slots that other nodes may free."""
+        return (device.group in self.shared and
+                device.identifier in self.waiting.get(device.group, {}))
+
+    def grant(self, group, requester=None):
+        """Give free slots to the most urgent waiters, waking them up."""
+        holders = self.holders.setdefault(group, set())
+        waiting = self.waiting.get(group, {})
+        if group in self.shared:
+            # Ask on their behalf; the queue is in the database
+            for identifier in waiting.keys():
+                if identifier != requester:
+                    timers.schedule(("device", identifier), 0, update_device,
+                            devices[identifier])
+            return
+        free = self.capacity(group) - len(holders)
+        if free <= 0 or not waiting:
+            return
+        for identifier in heapq.nsmallest(free, waiting,
+                key=lambda identifier: waiting[identifier]):
+            del waiting[identifier]
+            holders.add(identifier)
+            if identifier != requester:
+                timers.schedule(("device", identifier), 0, update_device,
+                        devices[identifier])
+
+    def holder_names(self, group):
+        if group in self.shared:
+            return ", ".join("%d (node %s)" % (identifier, node)
+                    for (identifier, node) in db.get_group_holders(group))
+        return ", ".join(str(identifier) for identifier in
+                sorted(self.holders.get(group, ())))
 
 
 class Device(object):
     """A device that can be controlled by the GPIO pins on the Pi."""
-    # Only one device per group can be on at a time
-    group_locks = {}
+    # Shares each group's capacity between its devices
+    arbiter = GroupArbiter()
 
     def __init__(self, io, identifier, group, type, display_name, pin, scheduler):
         self.io = io
@@ -127,65 +575,115 @@ class Device(object):
         self.pin = pin
         self.scheduler = scheduler
 
-        io.init_output(self.pin)
-
-        self.on = None
-        self.turn_off()
+        self.ledger = RuntimeLedger()
+        self.ledger.seed(db.get_device_history(
+            self.identifier, int(clock.time()) - RuntimeLedger.horizon))
+
+        # Pick up in the state history says the device was left in. One that
+        # was on when the daemon died keeps running, counting the time it
+        # was down as time on, until its first update decides otherwise;
+        # nothing is toggled or logged until the state actually changes.
+        self.on = self.ledger.on_since is not None
+        # (deadline, as of, seconds still needed) for the run in progress, so
+        # that a window ending before the device got its time can be reported
+        self.run = None
+        io.init_output(self.pin, 0 if self.on else 1)
+        if self.on:
+            logger.write_log("Device %s (%d) was on; resuming." % (
+                self.display_name, self.identifier))
 
         # TODO: Configure IO
 
+    def set_state(self, on):
+        """Queue the pin change for apply_outputs and record the change."""
+        pending_outputs[self.pin] = 0 if on else 1
+        self.on = on
+        logger.write_log("Turned %s device %s (%d)" % (
+            "ON" if on else "OFF", self.display_name, self.identifier))
+        db.log_device_enabled(self.identifier, on)
+        if on:
+            self.ledger.record_on(clock.time())
+        else:
+            self.ledger.record_off(clock.time())
+
     def turn_off(self):
-        if self.on == False:
+        Device.arbiter.release(self)
+        if not self.on:
             return
-
-        self.io.set_output(self.pin, 1)
-        self.on = False
-        logger.write_log("Turned OFF device %s (%d)" % (
-            self.display_name, self.identifier))
-        db.log_device_enabled(self.identifier, False)
-
-        if (self.group in Device.group_locks and
-                Device.group_locks[self.group] == self.identifier):
-            del Device.group_locks[self.group]
-
-    def turn_on(self):
-        if self.on == True:
+        self.set_state(False)
+
+    def turn_on(self, deadline=None, remaining=0):
+        """Turn on if the group has room; deadline and remaining (seconds)
+        decide the device's place in the queue if it doesn't."""
+        if deadline is None:
+            deadline = clock.time()
+        if not Device.arbiter.request(self, deadline, remaining):
+            if logger.level <= log.DEBUG:
+                logger.write_log("Device %s (%d) waiting on %s for group %d." % (
+                    self.display_name, self.identifier,
+                    Device.arbiter.holder_names(self.group), self.group),
+                    log.DEBUG)
+            if self.on:
+                # Resumed after a restart, but others got the group first
+                self.set_state(False)
             return
-
-        if (self.group in Device.group_locks and
-                Device.group_locks[self.group] != self.identifier):
-            # Some other device has the lock; defer
-            logger.write_log("Device %s (%d) waiting on %d for lock." % (
-                self.display_name, self.identifier, Device.group_locks[self.group]))
+        if self.on:
             return
+        self.set_state(True)
 
-        Device.group_locks[self.group] = self.identifier
-
-        self.io.set_output(self.pin, 0)
-        self.on = True
-        logger.write_log("Turned ON device %s (%d)" % (
-            self.display_name, self.identifier))
-        db.log_device_enabled(self.identifier, True)
-
+    @DEVICE_UPDATE_SECONDS.time
     def update(self):
+        """Apply the schedule; returns seconds until it could next change."""
+        start = timeit.default_timer()
         (enable, poll_time) = self.scheduler.should_enable(self)
+        SHOULD_ENABLE_SECONDS.observe(timeit.default_timer() - start)
         if enable:
-            self.turn_on()
+            self.turn_on(self.scheduler.deadline, self.scheduler.remaining)
+            self.run = (self.scheduler.deadline, clock.time(),
+                    self.scheduler.remaining)
+            if Device.arbiter.waiting_on_other_nodes(self):
+                poll_time = min(poll_time, GROUP_LEASE_POLL_INTERVAL)
         else:
             self.turn_off()
+            if self.run is not None:
+                (deadline, since, remaining) = self.run
+                if clock.time() >= deadline:
+                    self.missed_window(since, remaining)
+            self.run = None
         return poll_time
 
-    def get_last_seconds(self, seconds):
-        last_day = int(time.time()) - seconds
-        return db.get_device_history(self.identifier, last_day)
+    def missed_window(self, since, remaining):
+        now = clock.time()
+        short = remaining - self.ledger.seconds_on_since(since, now)
+        if short <= 0:
+            return
+        message = "Device %s (%d) was %d seconds short when its window " \
+                "ended." % (self.display_name, self.identifier, short)
+        logger.write_log("### %s" % message, log.WARNING)
+        alert("missed:%d" % self.identifier, "pi-timer missed watering window",
+                message)
+
+    def get_seconds_on(self, seconds):
+        """Seconds this device has been on in the last given seconds."""
+        now = clock.time()
+        return self.ledger.seconds_on_since(now - seconds, now)
 
 
 class Scheduler(object):
     """An object that determines when a device is enabled or disabled."""
+    # When should_enable last returned True: the time by which the current
+    # run must be done, and how many more seconds it needs
+    deadline = None
+    remaining = 0
+
     def should_enable(self, device):
         """Override this function in subclasses to do interesting things."""
         return (False, 10000)
 
+    def clock_stepped(self):
+        """Called when the wall clock jumps, before the next should_enable."""
+        pass
+
 
 class FixedScheduler(Scheduler):
     """Turn on at a certain hour/minute each day for given duration (sec).
@@ -197,213 +695,466 @@ class FixedScheduler(Scheduler):
     time.
     """
     def __init__(self, schedule):
+        self.set_schedule(schedule)
+
+    def set_schedule(self, schedule):
         self.schedule = schedule
+        self.index = schedules.ScheduleIndex(schedule, clock.time())
+
+    def clock_stepped(self):
+        # The index only covers the times around when it was built
+        self.index = schedules.ScheduleIndex(self.schedule, clock.time())
 
     def should_enable(self, device):
-        for item in self.schedule:
-            start_time = item["start_time"]
-            duration = item["duration"]
-            min_duration = item["min_duration"]
-            window = duration + 60*60
-            delta = (datetime.datetime.now() - start_time).total_seconds()
-            if delta < 0 or delta > window:
+        now = clock.time()
+        if self.index.expires is not None and now >= self.index.expires:
+            # Expand recurring items over the next window
+            self.index = schedules.ScheduleIndex(self.schedule, now)
+        (enable, poll_time) = self.check_index(device, now)
+        if self.index.expires is not None:
+            poll_time = min(poll_time, self.index.expires - now)
+        return (enable, poll_time)
+
+    def check_index(self, device, now):
+        for item in self.index.active(now):
+            if item.duration < item.min_duration:
                 continue
 
-            if duration < min_duration:
-                continue
+            total_seconds = device.get_seconds_on(item.window)
 
-            history = device.get_last_seconds(window)
-            start_time = None
-            total_seconds = 0
-            for row in history:
-                if row[1] == 1:
-                    start_time = row[0]
-                elif row[1] == 0:
-                    if start_time:
-                        total_seconds += row[0] - start_time
-                    start_time = None
-            if start_time:
-                total_seconds += int(time.time()) - start_time
-
-            if total_seconds < duration and (
-                device.on or (duration - total_seconds) > min_duration):
+            if total_seconds < item.duration and (
+                device.on or (item.duration - total_seconds) > item.min_duration):
                 if not device.on:
-                    logger.write_log("Device %d has been on %d sec. in last %d seconds." % (device.identifier, total_seconds, window))
-                    logger.write_log("Turning device on for %d sec." % (duration - total_seconds))
-                return (True, int(duration - total_seconds))
-
+                    logger.write_log("Device %d has been on %d sec. in last %d seconds." % (device.identifier, total_seconds, item.window), log.DEBUG)
+                    logger.write_log("Turning device on for %d sec." % (item.duration - total_seconds), log.DEBUG)
+                self.deadline = item.start + item.window
+                self.remaining = item.duration - total_seconds
+                return (True, min(self.remaining, self.deadline - now))
+
+        next_start = self.index.next_start(now)
+        if next_start is not None:
+            return (False, min(next_start - now, 10000))
         return (False, 10000)
 
 
 class DBScheduler(FixedScheduler):
     """Works like FixedScheduler, except the schedule is stored in the DB."""
     def __init__(self):
-        self.schedule = []
+        self.generation = None
+        self.set_schedule([])
 
     def should_enable(self, device):
-        schedule = (
-            db.get_device_schedule(device.identifier))
-        self.schedule = [
-            {
-                "start_time": datetime.datetime.fromtimestamp(item[0]),
-                "duration": item[2],
-                "min_duration": item[3]
-            }
-            for item in schedule]
+        generation = db.get_generation(db_module.SCHEDULE_GENERATION)
+        if generation != self.generation:
+            self.generation = generation
+            rows = db.get_device_schedule(device.identifier)
+            self.set_schedule([
+                {
+                    "start_time": db_module.from_schedule_timestamp(item[1]),
+                    "duration": item[2],
+                    "min_duration": item[3],
+                    "rrule": item[4],
+                    "exdates": item[5]
+                }
+                for item in rows])
         return super(DBScheduler, self).should_enable(device)
 
 
 class GoogleCalendarScheduler(FixedScheduler):
-    """Like FixedScheduler, but the schedule is stored in Google Calendar."""
+    """Like FixedScheduler, but the schedule is stored in Google Calendar,
+    plus any rows added to the device's schedule in the database with
+    timer.py (which may repeat)."""
     def __init__(self, min_duration, max_duration):
-        self.schedule = []
         self.min_duration = min_duration
         self.max_duration = max_duration
+        self.source = None
+        self.generation = None
+        self.manual = []
+        self.set_schedule([])
 
-    error_count = 0
+    # Published by the calendar sync thread; replaced wholesale, never edited
     schedules = {}
+    # The schedule generation refresh_devices last saw. Database rows are
+    # only read again when it changes, so polls run no SQL.
+    schedule_generation = None
 
-    @staticmethod
-    def update_from_gc():
-        # Update from GC once an hour
-        last_update = int(db.get_global("gcupdatetime"))
-        if int(time.time()) - last_update < 60*60:
-            return
-
-        logger.write_log("Syncing Google calendar")
-
-        (access_token, refresh_token) = db.get_tokens()
-
-        min_time = datetime.datetime.now() - datetime.timedelta(1)
-        max_time = datetime.datetime.now() + datetime.timedelta(1)
-
-        conn = httplib.HTTPSConnection("www.googleapis.com")
-        conn.request("GET", "/calendar/v3/calendars/%s/events?access_token=%s" % (
-            secrets.CALENDAR_ID, access_token))
-        res = json.loads(conn.getresponse().read())
-        if "error" in res:
-            GoogleCalendarScheduler.error_count += 1
-            if GoogleCalendarScheduler.error_count > 3:
-                # Send an email and shut down.
-                raise Exception("Failed to load calendar 3 times in a row. Giving up.")
-
-            logger.write_log("### Error getting calendar, attempting to refresh token:\n%s" % res["error"]["message"])
-            conn = httplib.HTTPSConnection("accounts.google.com")
-            conn.request("POST", "/o/oauth2/token", "client_id=%s&client_secret=%s&refresh_token=%s&grant_type=refresh_token" % (
-                secrets.OAUTH_CLIENT_ID, secrets.OAUTH_SECRET, refresh_token),
-                {"Content-Type": "application/x-www-form-urlencoded"})
-            try:
-                res = json.loads(conn.getresponse().read())
-            except Exception, e:
-                logger.write_log("### Error parsing response: %s. Trying again..." % e)
-                return
-            db.set_tokens(res["access_token"], refresh_token)
-            return
-
-        GoogleCalendarScheduler.error_count = 0
+    def should_enable(self, device):
+        source = GoogleCalendarScheduler.schedules.get(device.identifier, [])
+        generation = GoogleCalendarScheduler.schedule_generation
+        if source is not self.source or generation != self.generation:
+            if generation != self.generation:
+                self.generation = generation
+                self.manual = [
+                    {
+                        "start_time": db_module.from_schedule_timestamp(row[1]),
+                        "duration": row[2],
+                        "min_duration": row[3],
+                        "rrule": row[4],
+                        "exdates": row[5]
+                    }
+                    for row in db.get_manual_schedules(device.identifier)]
+            self.source = source
+            self.load_schedule(source)
+        return super(GoogleCalendarScheduler, self).should_enable(device)
 
-        # Clear all schedules
-        for device_id in GoogleCalendarScheduler.schedules.keys():
-            db.clear_device_schedule(device_id)
+    def load_schedule(self, source):
+        schedule = list(self.manual)
+        for item in source:
+            schedule_item = {
+                "start_time": item["start_time"],
+                "duration": item["duration"],
+                "min_duration": self.min_duration
+            }
+            if schedule_item["duration"] > self.max_duration:
+                logger.write_log("ERROR! Duration of %d seconds exceeded maximum of %d! Clamping." % (schedule_item["duration"], self.max_duration), log.WARNING)
+                schedule_item["duration"] = self.max_duration
+            schedule.append(schedule_item)
+        self.set_schedule(schedule)
+
+
+def update_device(device):
+    statements = db.conn.statements
+    poll_time = device.update()
+    stats["polls"] += 1
+    stats["poll_statements"] += db.conn.statements - statements
+    if data_service:
+        publish_summary(device)
+    timers.schedule(("device", device.identifier), poll_time,
+            update_device, device)
+
+
+def publish_summary(device):
+    """Hand the device's current state to the data service."""
+    now = clock.time()
+    today = db_module.day_start(now)
+    index = getattr(device.scheduler, "index", None)
+    next_run = index.next_item(now) if index else None
+    data_service.publish(device.identifier, {
+        "on": bool(device.on),
+        "on_since": device.ledger.on_since,
+        "seconds_today": device.ledger.seconds_on_since(today, now),
+        "runs_today": device.ledger.runs_since(today),
+        "next_run": next_run and {
+            "start": next_run.start,
+            "duration": next_run.duration
+        },
+        "updated": now,
+    })
+
+
+def remove_device(identifier):
+    device = devices.pop(identifier)
+    del device_rows[identifier]
+    timers.cancel(("device", identifier))
+    device.turn_off()
+    if data_service:
+        data_service.remove(identifier)
+
+
+def refresh_devices():
+    timers.schedule("devices", DEVICE_REFRESH_INTERVAL, refresh_devices)
+
+    generation = db.get_generation(db_module.SCHEDULE_GENERATION)
+    if generation != generations.get("schedule"):
+        generations["schedule"] = generation
+        GoogleCalendarScheduler.schedule_generation = generation
+        if not args.calendar_sync:
+            # Another node syncs the calendar into the database
+            GoogleCalendarScheduler.schedules = db.get_calendar_schedules()
+        # Devices with schedules stored in the DB need to look again
+        for device in devices.itervalues():
+            timers.schedule(("device", device.identifier), 0,
+                    update_device, device)
+
+    generation = db.get_generation(db_module.DEVICES_GENERATION)
+    if generation == generations.get("devices"):
+        return
+    generations["devices"] = generation
+
+    all_rows = db.list_devices()
+    # Only this node's devices are ours to control
+    rows = dict((device[0], device) for device in all_rows
+            if device[5] == args.node)
+    for identifier in device_rows.keys():
+        if rows.get(identifier) != device_rows[identifier]:
+            logger.write_log("Device %d was removed or changed." % identifier)
+            remove_device(identifier)
+
+    # Groups that also have devices on other nodes share slots through leases
+    nodes = {}
+    for device in all_rows:
+        nodes.setdefault(device[1], set()).add(device[5])
+    Device.arbiter.set_groups(db.get_group_capacities(),
+            set(group for (group, group_nodes) in nodes.iteritems()
+                if args.node in group_nodes and len(group_nodes) > 1))
+
+    # Devices left on take their slots back before any device updates
+    for (identifier, device) in rows.iteritems():
+        if identifier not in devices:
+            device_rows[identifier] = device
+            devices[identifier] = (
+                Device(io, device[0], device[1], device[2], device[3], device[4],
+                    GoogleCalendarScheduler(60, 1200)))
+            if devices[identifier].on:
+                Device.arbiter.resume(devices[identifier])
+            timers.schedule(("device", identifier), 0,
+                    update_device, devices[identifier])
+
+
+def check_clock_step():
+    """Re-evaluate every device if the wall clock has stepped since the last
+    check; otherwise a device could sleep through its new window, or stay on
+    past its old one, until its timer came due."""
+    global clock_offset
+    offset = clock.time() - clock.monotonic()
+    if clock_offset is not None and \
+            abs(offset - clock_offset) > CLOCK_STEP_THRESHOLD:
+        logger.write_log("Wall clock stepped by %+d seconds; re-evaluating "
+                "devices." % (offset - clock_offset), log.WARNING)
+        for device in devices.itervalues():
+            device.scheduler.clock_stepped()
+            timers.schedule(("device", device.identifier), 0,
+                    update_device, device)
+    clock_offset = offset
 
-        GoogleCalendarScheduler.schedules = {}
 
-        for event in res.get("items", []):
-            if event.get("status", "") == "cancelled:":
-                continue
-            if event.get("summary", ":").split(":")[0] == "device":
-                event_id = event["id"]
-                device_id = int(event["summary"].split(":")[1])
-                logger.write_log("Syncing device %d" % device_id)
-                conn.request("GET", "/calendar/v3/calendars/%s/events/%s/instances?timeMin=%s-07:00&timeMax=%s-07:00&access_token=%s" % (
-                    secrets.CALENDAR_ID, event_id, min_time.isoformat('T'), max_time.isoformat('T'), access_token))
-                res = json.loads(conn.getresponse().read())
-
-
-                for instance in res.get("items", []):
-                    start_time = datetime.datetime.strptime(instance["start"]["dateTime"][:-6], "%Y-%m-%dT%H:%M:%S")
-                    end_time = datetime.datetime.strptime(instance["end"]["dateTime"][:-6], "%Y-%m-%dT%H:%M:%S")
-                    schedule = {
-                        "start_time": start_time,
-                        "duration": (end_time-start_time).total_seconds()
-                    }
-                    logger.write_log("Device %d runs at %s for up to %d seconds" % (device_id, schedule["start_time"], schedule["duration"]))
-                    GoogleCalendarScheduler.schedules.setdefault(device_id, [])
-                    GoogleCalendarScheduler.schedules[device_id].append(schedule)
-                    db.set_device_schedule(device_id, schedule["start_time"], schedule["duration"], 0)
+def sync_calendar():
+    calendar_sync.request_sync()
+    timers.schedule("calendar", CALENDAR_SYNC_INTERVAL, sync_calendar)
 
-        db.set_global("gcupdatetime", str(int(time.time())))
 
-    def should_enable(self, device):
-        self.update_from_gc()
-        
-        if device.identifier in GoogleCalendarScheduler.schedules:
-            self.schedule = []
-            for item in GoogleCalendarScheduler.schedules[device.identifier]:
-                schedule_item = {
-                    "start_time": item["start_time"],
-                    "duration": item["duration"],
-                    "min_duration": self.min_duration
-                }
-                if schedule_item["duration"] > self.max_duration:
-                    logger.write_log("ERROR! Duration of %d seconds exceeded maximum of %d! Clamping." % (schedule_item["duration"], self.max_duration))
-                    schedule_item["duration"] = self.max_duration
-                self.schedule.append(schedule_item)
-
-        return super(GoogleCalendarScheduler, self).should_enable(device)
+def publish_schedules(schedules):
+    GoogleCalendarScheduler.schedules = schedules
+    # Every device may have a new schedule
+    for device in devices.itervalues():
+        timers.schedule(("device", device.identifier), 0,
+                update_device, device)
+
+
+def calendar_failed(error):
+    raise Exception("Calendar sync failed:\n%s" % error)
+
+
+def flush_history():
+    db.flush()
+    timers.schedule("flush", db.flush_interval, flush_history)
+
+
+def compact_history():
+    HISTORY_ROWS.set(db.count_history())
+    if db.compact_history():
+        timers.schedule("compact", COMPACT_BACKLOG_INTERVAL, compact_history)
+    else:
+        timers.schedule("compact", COMPACT_INTERVAL, compact_history)
+
+
+def write_stats(filename, latencies, wall_seconds):
+    """Summarize a simulation run as JSON."""
+    latencies.sort()
+    def percentile(p):
+        if not latencies:
+            return 0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+    result = {
+        "devices": len(devices),
+        "simulated_days": args.simulate,
+        "wall_seconds": wall_seconds,
+        "iterations": len(latencies),
+        "latency_mean": sum(latencies) / max(len(latencies), 1),
+        "latency_p50": percentile(0.5),
+        "latency_p99": percentile(0.99),
+        "latency_max": percentile(1),
+        "polls": stats["polls"],
+        "statements": db.conn.statements,
+        "statements_per_poll": (
+            float(stats["poll_statements"]) / max(stats["polls"], 1)),
+    }
+    f = sys.stdout if filename == "-" else open(filename, "w")
+    json.dump(result, f, indent=2, sort_keys=True)
+    f.write("\n")
+    if f is not sys.stdout:
+        f.close()
 
 
 # Main entry point
-logger = Logger()
+parser = argparse.ArgumentParser(description='Run devices on their schedules')
+parser.add_argument('--db', default=DB_FILENAME)
+parser.add_argument('--log', default=LOG_FILENAME)
+parser.add_argument('--simulate', type=float, metavar='DAYS',
+        help='run on a virtual clock with dummy IO for DAYS, then exit')
+parser.add_argument('--stats', metavar='FILE',
+        help='with --simulate, write loop statistics to FILE as JSON')
+parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+        help='serve /metrics on this local port (0 to disable)')
+parser.add_argument('--data-port', type=int, default=DATA_PORT,
+        help='serve dashboard data on this local port (0 to disable)')
+parser.add_argument('--node',
+        help='control only the devices assigned to this node name')
+parser.add_argument('--no-calendar-sync', dest='calendar_sync',
+        action='store_false',
+        help='leave syncing Google Calendar to another node sharing the database')
+parser.add_argument('--io', default='auto',
+        choices=['auto', 'rpi', 'mmap', 'shift', 'dummy'],
+        help='output backend (see deviceio.py); auto uses RPi.GPIO if '
+             'installed, otherwise dummy')
+parser.add_argument('--io-path', metavar='PATH',
+        help='device file for the mmap (/dev/gpiomem) or shift '
+             '(/dev/spidev0.0) backend')
+parser.add_argument('--shift-chips', type=int, default=1,
+        help='number of chained shift registers for --io shift')
+parser.add_argument('--durability', default=HISTORY_DURABILITY,
+        choices=[db_module.DURABILITY_STRICT, db_module.DURABILITY_BATCHED],
+        help='sync every history row to disk (strict), or leave syncing to '
+             'checkpoints to spare the SD card (batched)')
+args = parser.parse_args()
+
+stop_time = None
+if args.simulate:
+    # Time passes only while the loop waits, so days go by in seconds
+    clock = clock_module.VirtualClock(time.time())
+    stop_time = clock.time() + args.simulate*24*60*60
+    init_watchdog = keep_alive = close_watchdog = no_watchdog
+else:
+    clock = clock_module.SystemClock()
+
+logger = log.Logger(args.log, LOG_LEVEL, clock=clock)
 devices = {}
+# clock.time() - clock.monotonic() at the last check_clock_step
+clock_offset = None
+# The devices table row each device was created from
+device_rows = {}
+# Last seen db.DB.get_generation values
+generations = {}
+# Counts of device polls and the SQL statements they ran
+stats = collections.Counter()
+timers = TimerQueue(clock)
+# {pin: level} set by devices since the last apply_outputs
+pending_outputs = {}
+io = None
+metrics_server = None
+data_service = None
+alert_sender = None
+# (key, subject, body) of the alert for an unexpected exit
+crash_alert = None
 try:
-    db = db.DB('/var/lib/pi-timer/db.sqlite', logger)
+    db = db_module.DB(args.db, logger, args.durability, clock=clock,
+            busy_timeout=DB_BUSY_TIMEOUT)
 except:
-    logger.write_log("### Caught exception:\n%s" % traceback.format_exc())
+    logger.write_log("### Caught exception:\n%s" % traceback.format_exc(),
+            log.ERROR)
     logger.close()
     sys.exit(0)
+if not args.simulate:
+    alert_sender = alerts.AlertSender(db, logger, SMTP_HOST, SMTP_PORT,
+        secrets.FROM_ADDRESS, secrets.EMAIL_ADDRESS, secrets.EMAIL_ADDRESS,
+        secrets.EMAIL_PASSWORD)
+# The sync thread, the alert sender and the data service share db; each
+# thread gets its own connection
+calendar_sync = gcal.CalendarSync(db, logger,
+    lambda schedules: timers.post(publish_schedules, schedules),
+    lambda error: timers.post(calendar_failed, error),
+    warn=lambda error: alert("calendar", "pi-timer calendar sync failing",
+        error))
     
 try:
-    db.set_global("gcupdatetime", "0")
-
-    init_watchdog()
-    io = DeviceIO()
-
-    while True:
-        # Fetch devices
-        for device in db.list_devices():
-            if device[0] not in devices:
-                devices[device[0]] = (
-                    Device(io, device[0], device[1], device[2], device[3], device[4],
-                        GoogleCalendarScheduler(60, 1200)))
-
-        next_poll = 60
-        # Update each device's schedule once per minute unless a device needs
-        # a shorter update
-        for device in devices.itervalues():
-            next_poll = min(next_poll, device.update())
-
-        for i in xrange(0, next_poll):
-            # Sleep for 1 second at a time, up until it's time to poll again
-            time.sleep(1)
-            keep_alive()
-            if kill_signal:
-                break
-
-        if kill_signal:
-            logger.write_log("### Caught TERM signal. Exiting.")
-            break
+    # Start from the schedule the last calendar sync stored, so devices run
+    # correctly right away even if Google can't be reached
+    GoogleCalendarScheduler.schedules = db.get_calendar_schedules()
+
+    timers.schedule("watchdog", WATCHDOG_ARM_DELAY, init_watchdog)
+    io = open_io()
+    if alert_sender:
+        queue_spooled_alerts()
+        # Also sends anything a previous run queued but didn't get out
+        alert_sender.start()
+    if not args.simulate and args.calendar_sync:
+        calendar_sync.start()
+        timers.schedule("calendar", 0, sync_calendar)
+    HISTORY_ROWS.set(db.count_history())
+
+    if args.metrics_port and not args.simulate:
+        try:
+            metrics_server = metrics.MetricsServer(registry, args.metrics_port)
+            metrics_server.start()
+        except socket.error, e:
+            logger.write_log("### Not serving metrics on port %d: %s" % (
+                args.metrics_port, e), log.WARNING)
+    if args.data_port and not args.simulate:
+        try:
+            data_service = dataservice.DataService(db, args.data_port)
+            data_service.start()
+        except socket.error, e:
+            data_service = None
+            logger.write_log("### Not serving data on port %d: %s" % (
+                args.data_port, e), log.WARNING)
+
+    timers.schedule("devices", 0, refresh_devices)
+    timers.schedule("flush", db.flush_interval, flush_history)
+    timers.schedule("compact", COMPACT_INTERVAL, compact_history)
+    timers.schedule("leases", GROUP_LEASE_RENEW_INTERVAL,
+            Device.arbiter.renew_leases)
+
+    # Wall time spent on each iteration, when simulating
+    latencies = []
+    started = timeit.default_timer()
+    last_keep_alive = None
+    while not kill_signal and (stop_time is None or clock.time() < stop_time):
+        # Each device is only updated when its schedule says its state could
+        # change; in between, sleep until the earliest of those times.
+        iteration_start = timeit.default_timer()
+        check_clock_step()
+        timers.run_due()
+        apply_outputs()
+        # Resuming after a crash relies on history having every state
+        # change, so commit this iteration's before sleeping
+        db.flush()
+        keep_alive()
+        now = clock.monotonic()
+        if last_keep_alive is not None:
+            WATCHDOG_SLACK_SECONDS.observe(
+                    WATCHDOG_TIMEOUT - (now - last_keep_alive))
+        last_keep_alive = now
+        if args.simulate:
+            latencies.append(timeit.default_timer() - iteration_start)
+        timers.wait(WATCHDOG_INTERVAL)
+
+    if args.simulate:
+        logger.write_log("Simulation finished.")
+        if args.stats:
+            write_stats(args.stats, latencies,
+                    timeit.default_timer() - started)
+    else:
+        logger.write_log("### Caught TERM signal. Exiting.")
 
 except:
     error_str = traceback.format_exc()
-    logger.write_log("### Caught exception:\n%s" % error_str)
+    logger.write_log("### Caught exception:\n%s" % error_str, log.ERROR)
     if "KeyboardInterrupt" not in error_str:
-        send_email("pi-timer critical error",
-                "Pi Timer has encountered an error:\n%s" % error_str)
+        crash_alert = ("error: %s" % error_str.strip().splitlines()[-1],
+                "pi-timer critical error",
+                "Pi Timer has encountered an error:\n%s\nRecent log:\n%s" % (
+                    error_str, logger.tail()))
 finally:
     for device in devices.itervalues():
         device.turn_off()
-    io.close()
+    if io:
+        apply_outputs()
+    # Only once devices are off, since even this can wait on the database
+    if crash_alert:
+        alert(*crash_alert, delay=0)
+    db.flush()
+    if metrics_server:
+        metrics_server.stop()
+    if data_service:
+        data_service.stop()
+    calendar_sync.stop()
+    if io:
+        logger.write_log("Closing outputs.")
+        io.close()
+    timers.close()
+    close_watchdog()
+    if alert_sender:
+        # Never waits on the mail server; what's unsent goes out next start
+        alert_sender.stop()
     db.close()
     logger.close()
-    close_watchdog()
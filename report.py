@@ -0,0 +1,458 @@
+import array
+import bisect
+import csv
+import datetime
+import itertools
+import json
+import time
+
+import db as db_module
+import schedules
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+PERIODS = ["day", "week"]
+
+FIELDS = ["device", "display_name", "period", "runtime", "runs",
+          "duty_cycle", "scheduled", "missed", "water"]
+
+# Scheduled runs that come up short by no more than this, plus the run's
+# min_duration, still count as made
+MISSED_SLACK = 5
+
+# Added to device indexes so that all devices' times can share one sorted
+# array; larger than any timestamp
+DEVICE_STRIDE = 1 << 40
+
+
+def period_bounds(from_timestamp, to_timestamp, period):
+    """Local midnights starting the days (or Monday-starting weeks) that
+    cover [from, to), plus the one after the last."""
+    date = datetime.date.fromtimestamp(from_timestamp)
+    step = 1
+    if period == "week":
+        date -= datetime.timedelta(date.weekday())
+        step = 7
+    bounds = [int(time.mktime(date.timetuple()))]
+    while bounds[-1] < to_timestamp:
+        date += datetime.timedelta(step)
+        bounds.append(int(time.mktime(date.timetuple())))
+    return bounds
+
+
+def report_days(from_timestamp, end):
+    """(date, midnight, next midnight) for each day in [from, end)."""
+    bounds = period_bounds(from_timestamp, end, "day")
+    return [(datetime.date.fromtimestamp(bounds[i]), bounds[i], bounds[i + 1])
+            for i in xrange(len(bounds) - 1)]
+
+
+def scheduled_runs(schedule, days, end, cache):
+    """(start, window, duration, min_duration) of the runs a device's
+    schedule rows call for on the given days, before end.
+
+    cache is shared between calls: devices often have the same rule, so the
+    days it matches are only worked out once.
+    """
+    days_by_date = dict((day[0], day) for day in days)
+    runs = []
+    for row in schedule:
+        start_time = db_module.from_schedule_timestamp(row[1])
+        (duration, min_duration, rrule, exdates) = row[2:6]
+        if duration < min_duration:
+            # The daemon never runs these
+            continue
+        first = start_time.date()
+        if rrule:
+            key = (rrule, exdates, first)
+            if key not in cache:
+                recurrence = schedules.Recurrence(rrule, exdates)
+                cache[key] = [day for day in days
+                        if recurrence.runs_on(first, day[0])]
+            run_days = cache[key]
+        else:
+            run_days = [days_by_date[first]] if first in days_by_date else []
+
+        window = duration + schedules.WINDOW_GRACE
+        offset = (start_time - datetime.datetime.combine(
+                first, datetime.time())).seconds
+        for (date, midnight, next_midnight) in run_days:
+            if next_midnight - midnight == 24*60*60:
+                start = midnight + offset
+            else:
+                # The clocks change that day
+                start = int(schedules.to_seconds(
+                        datetime.datetime.combine(date, start_time.time())))
+            if start < end:
+                runs.append((start, window, duration, min_duration))
+    return runs
+
+
+class Columns(object):
+    """History as on/off intervals and scheduled runs in parallel columns.
+
+    Devices are numbered 0..n-1 in ID order. Intervals are sorted by device
+    and then start, so each column is a flat array (a NumPy one when NumPy
+    is installed, otherwise an array.array) and every aggregate below is a
+    pass over whole columns rather than a query per device or period.
+    """
+    def __init__(self, device_ids):
+        self.device_ids = sorted(device_ids)
+        self.device_index = dict(
+                (device, index) for (index, device) in enumerate(self.device_ids))
+
+    def load_intervals(self, rows, on_since, from_timestamp, end):
+        """Pair (device, timestamp, enabled) rows, sorted by device and then
+        time, into intervals clipped to [from, end].
+
+        on_since is {device: time} for devices already on at from, or for
+        devices whose history is compacted past from, on when their rows
+        start (see DB.get_history_on_since). Repeated rows with the same
+        state are ignored, as is an off row with no on row before it.
+        """
+        if numpy is not None:
+            self._load_intervals_numpy(rows, on_since, from_timestamp, end)
+        else:
+            self._load_intervals_array(rows, on_since, from_timestamp, end)
+
+    def _load_intervals_numpy(self, rows, on_since, from_timestamp, end):
+        def ints(values):
+            return numpy.array(values, dtype=numpy.int64)
+
+        history = numpy.fromiter(itertools.chain.from_iterable(rows),
+                numpy.int64, 3 * len(rows)).reshape(-1, 3)
+        count = len(history)
+        # Devices already on start with an on row at from (or where their
+        # rows start), and every device ends with an off row at end; order
+        # breaks ties in time so that these come first and last.
+        initial = sorted(on_since)
+        final = sorted(set(on_since) | set(history[:, 0].tolist()))
+        devices = numpy.concatenate([history[:, 0], ints(initial), ints(final)])
+        timestamps = numpy.concatenate([history[:, 1],
+                ints([max(on_since[device], from_timestamp)
+                      for device in initial]),
+                ints([end] * len(final))])
+        enabled = numpy.concatenate([history[:, 2],
+                ints([1] * len(initial)), ints([0] * len(final))])
+        order = numpy.concatenate([ints(xrange(count)),
+                ints([-1] * len(initial)), ints([count] * len(final))])
+        sort = numpy.lexsort((order, timestamps, devices))
+        (devices, timestamps, enabled, order) = (devices[sort],
+                timestamps[sort], enabled[sort], order[sort])
+        timestamps = numpy.clip(timestamps, from_timestamp, end)
+
+        # Keep only changes of state, with every device starting off, so
+        # that what is left alternates on, off, on, off per device
+        previous = numpy.concatenate([ints([0]), enabled[:-1]])
+        previous[numpy.concatenate([[True], devices[1:] != devices[:-1]])] = 0
+        changed = enabled != previous
+        on = changed & (enabled == 1)
+        off = changed & (enabled == 0)
+
+        self.owners = numpy.searchsorted(
+                ints(self.device_ids), devices[on]).astype(numpy.int64)
+        self.starts = timestamps[on]
+        self.ends = timestamps[off]
+        # Runs that were already going at from weren't started in the report
+        self.started = order[on] >= 0
+
+    def _load_intervals_array(self, rows, on_since, from_timestamp, end):
+        self.owners = array.array('l')
+        self.starts = array.array('l')
+        self.ends = array.array('l')
+        self.started = array.array('b')
+
+        def close(device, since, started, stop):
+            if since is not None:
+                self.owners.append(self.device_index[device])
+                self.starts.append(max(since, from_timestamp))
+                self.ends.append(min(stop, end))
+                self.started.append(started)
+
+        current = None
+        since = None
+        started = 0
+        for (device, timestamp, enabled) in rows:
+            if device != current:
+                close(current, since, started, end)
+                current = device
+                since = on_since.get(device)
+                started = 0
+            if enabled and since is None:
+                since = timestamp
+                started = 1
+            elif not enabled and since is not None:
+                close(device, since, started, timestamp)
+                since = None
+        close(current, since, started, end)
+
+        idle = sorted(set(on_since) - set(row[0] for row in rows))
+        for device in idle:
+            close(device, on_since[device], 0, end)
+
+        # Devices that were on throughout were appended out of order
+        if idle:
+            sort = sorted(xrange(len(self.owners)),
+                    key=lambda i: (self.owners[i], self.starts[i]))
+            for name in ("owners", "starts", "ends", "started"):
+                column = getattr(self, name)
+                setattr(self, name, array.array(column.typecode,
+                        [column[i] for i in sort]))
+
+    def load_runs(self, runs):
+        """runs is {device: [(start, window, duration, min_duration)]}."""
+        flat = sorted((self.device_index[device],) + run
+                for (device, device_runs) in runs.items() for run in device_runs)
+        columns = zip(*flat) or [[]] * 5
+        if numpy is not None:
+            (self.run_owners, self.run_starts, self.run_windows,
+             self.run_durations, self.run_min_durations) = [
+                numpy.array(column, dtype=numpy.int64) for column in columns]
+        else:
+            (self.run_owners, self.run_starts, self.run_windows,
+             self.run_durations, self.run_min_durations) = [
+                array.array('l', column) for column in columns]
+
+    def seconds_on(self, owners, starts, ends):
+        """Seconds each device in owners was on during [starts[i], ends[i]).
+
+        The intervals are keyed by device and start in one sorted array, and
+        the time on before any moment is a running total up to the last
+        interval starting before it, less whatever of that interval is still
+        to come. Intervals belonging to another device are never still going.
+        """
+        if numpy is not None:
+            if not len(self.starts):
+                return numpy.zeros(len(owners), dtype=numpy.int64)
+            interval_starts = self.owners * DEVICE_STRIDE + self.starts
+            interval_ends = self.owners * DEVICE_STRIDE + self.ends
+            totals = numpy.concatenate([[0], numpy.cumsum(self.ends - self.starts)])
+
+            def on_before(times):
+                keys = owners * DEVICE_STRIDE + times
+                index = numpy.searchsorted(interval_starts, keys, side="right")
+                rest = numpy.where(index > 0,
+                        interval_ends[index - 1] - keys, 0)
+                return totals[index] - numpy.maximum(rest, 0)
+
+            return on_before(ends) - on_before(starts)
+
+        interval_starts = [self.owners[i] * DEVICE_STRIDE + self.starts[i]
+                for i in xrange(len(self.starts))]
+        totals = [0]
+        for i in xrange(len(self.starts)):
+            totals.append(totals[-1] + self.ends[i] - self.starts[i])
+
+        def on_before(owner, moment):
+            key = owner * DEVICE_STRIDE + moment
+            index = bisect.bisect_right(interval_starts, key)
+            if index == 0:
+                return 0
+            last = index - 1
+            rest = self.owners[last] * DEVICE_STRIDE + self.ends[last] - key
+            return totals[index] - max(rest, 0)
+
+        return array.array('l', [
+            on_before(owners[i], ends[i]) - on_before(owners[i], starts[i])
+            for i in xrange(len(owners))])
+
+
+class Report(object):
+    """Per-device, per-period totals accumulated from Columns.
+
+    Each total is a row per device with a column per period, stored flat.
+    """
+    def __init__(self, device_count, bounds):
+        self.bounds = bounds
+        self.periods = len(bounds) - 1
+        size = device_count * self.periods
+        if numpy is not None:
+            (self.runtime, self.runs, self.scheduled, self.missed) = [
+                numpy.zeros(size, dtype=numpy.int64) for i in xrange(4)]
+        else:
+            (self.runtime, self.runs, self.scheduled, self.missed) = [
+                array.array('l', [0]) * size for i in xrange(4)]
+
+    def period_of(self, timestamps, side="right"):
+        """Index of the period each time falls in. With side="left", a time
+        on a boundary belongs to the period before it."""
+        if numpy is not None:
+            return numpy.searchsorted(self.bounds, timestamps, side=side) - 1
+        search = bisect.bisect_right if side == "right" else bisect.bisect_left
+        return array.array('l', [search(self.bounds, timestamp) - 1
+                for timestamp in timestamps])
+
+    def add(self, total, owners, periods, values):
+        if numpy is not None:
+            total += numpy.bincount(owners * self.periods + periods,
+                    weights=values, minlength=len(total)).astype(numpy.int64)
+            return
+        for i in xrange(len(owners)):
+            total[owners[i] * self.periods + periods[i]] += values[i]
+
+    def add_intervals(self, columns):
+        first = self.period_of(columns.starts)
+        last = self.period_of(columns.ends, side="left")
+        if numpy is not None:
+            last = numpy.maximum(first, last)
+            within = first == last
+            self.add(self.runtime, columns.owners[within], first[within],
+                    (columns.ends - columns.starts)[within])
+            self.add(self.runs, columns.owners[columns.started],
+                    first[columns.started],
+                    numpy.ones(numpy.count_nonzero(columns.started)))
+            crossing = numpy.nonzero(~within)[0]
+        else:
+            last = array.array('l', map(max, first, last))
+            crossing = []
+            for i in xrange(len(first)):
+                if first[i] == last[i]:
+                    self.runtime[columns.owners[i] * self.periods + first[i]] += (
+                        columns.ends[i] - columns.starts[i])
+                else:
+                    crossing.append(i)
+                if columns.started[i]:
+                    self.runs[columns.owners[i] * self.periods + first[i]] += 1
+
+        # Only runs going at midnight (or at the start of a week) are split
+        for i in crossing:
+            row = int(columns.owners[i]) * self.periods
+            for period in xrange(int(first[i]), int(last[i]) + 1):
+                start = max(columns.starts[i], self.bounds[period])
+                end = min(columns.ends[i], self.bounds[period + 1])
+                self.runtime[row + period] += end - start
+
+    def add_rollups(self, columns, rollups):
+        """Add compacted (device, day, seconds_on, activations) rows."""
+        rollups = [row for row in rollups if row[0] in columns.device_index]
+        owners = [columns.device_index[row[0]] for row in rollups]
+        periods = self.period_of([row[1] for row in rollups])
+        if numpy is not None:
+            owners = numpy.array(owners, dtype=numpy.int64)
+        self.add(self.runtime, owners, periods, [row[2] for row in rollups])
+        self.add(self.runs, owners, periods, [row[3] for row in rollups])
+
+    def add_runs(self, columns, covered_from, end):
+        """Count scheduled runs, and those whose window had ended by end and
+        that got less time on in it than they asked for. Runs before
+        covered_from, where only rollups are left, can't be checked."""
+        periods = self.period_of(columns.run_starts)
+        if numpy is not None:
+            self.add(self.scheduled, columns.run_owners, periods,
+                    numpy.ones(len(periods)))
+            window_ends = columns.run_starts + columns.run_windows
+            check = (columns.run_starts >= covered_from) & (window_ends <= end)
+            on = columns.seconds_on(columns.run_owners[check],
+                    columns.run_starts[check], window_ends[check])
+            short = (columns.run_durations[check] - on >
+                    columns.run_min_durations[check] + MISSED_SLACK)
+            self.add(self.missed, columns.run_owners[check][short],
+                    periods[check][short], numpy.ones(numpy.count_nonzero(short)))
+            return
+
+        self.add(self.scheduled, columns.run_owners, periods,
+                [1] * len(periods))
+        check = [i for i in xrange(len(periods))
+                if columns.run_starts[i] >= covered_from and
+                columns.run_starts[i] + columns.run_windows[i] <= end]
+        on = columns.seconds_on([columns.run_owners[i] for i in check],
+                [columns.run_starts[i] for i in check],
+                [columns.run_starts[i] + columns.run_windows[i] for i in check])
+        for (i, seconds) in zip(check, on):
+            if (columns.run_durations[i] - seconds >
+                    columns.run_min_durations[i] + MISSED_SLACK):
+                self.missed[columns.run_owners[i] * self.periods + periods[i]] += 1
+
+
+def build_report(database, from_timestamp, to_timestamp, period="day",
+                 device=None, now=None):
+    """Runtime, runs, duty cycle, scheduled and missed runs and water use
+    per device per period, for the days or weeks covering [from, to).
+
+    Yields one dict per device and period, by device and then period, with
+    the keys in FIELDS. Water use is the runtime in minutes times the
+    device's flow rate, or None if it has none.
+    """
+    if now is None:
+        now = time.time()
+    bounds = period_bounds(from_timestamp, to_timestamp, period)
+    from_timestamp = bounds[0]
+    end = int(min(to_timestamp, now))
+
+    names = dict((row[0], row[3]) for row in database.list_devices())
+    rows = database.get_history_columns(from_timestamp, end)
+    # Devices compacted past end have nothing left to pair
+    on_since = dict((key, value) for (key, value) in
+            database.get_history_on_since(from_timestamp).items()
+            if value < end)
+    rollups = database.get_daily_rollups(from_timestamp, end)
+    device_ids = (set(names) | set(row[0] for row in rows) |
+            set(on_since) | set(row[0] for row in rollups))
+    if device is not None:
+        device_ids = set([device])
+        rows = [row for row in rows if row[0] == device]
+        on_since = dict((key, value) for (key, value) in on_since.items()
+                if key == device)
+
+    columns = Columns(device_ids)
+    columns.load_intervals(rows, on_since, from_timestamp, end)
+    days = report_days(from_timestamp, end)
+    cache = {}
+    columns.load_runs(dict(
+        (device_id, scheduled_runs(database.get_device_schedule(device_id),
+                days, end, cache))
+        for device_id in columns.device_ids))
+
+    report = Report(len(columns.device_ids), bounds)
+    report.add_intervals(columns)
+    report.add_rollups(columns, rollups)
+    covered_from = database.get_raw_history_start()
+    if covered_from is not None:
+        report.add_runs(columns, covered_from, end)
+
+    # Periods that have started, by name and how much of each has passed
+    periods = [(datetime.date.fromtimestamp(bounds[i]).isoformat(),
+                min(bounds[i + 1], end) - bounds[i])
+               for i in xrange(report.periods) if bounds[i] < end]
+    flow_rates = database.get_flow_rates()
+    for (index, device_id) in enumerate(columns.device_ids):
+        flow_rate = flow_rates.get(device_id)
+        for (period_index, (name, length)) in enumerate(periods):
+            cell = index * report.periods + period_index
+            runtime = int(report.runtime[cell])
+            yield {
+                "device": device_id,
+                "display_name": names.get(device_id, ""),
+                "period": name,
+                "runtime": runtime,
+                "runs": int(report.runs[cell]),
+                "duty_cycle": round(float(runtime) / length, 4),
+                "scheduled": int(report.scheduled[cell]),
+                "missed": int(report.missed[cell]),
+                "water": (round(runtime / 60.0 * flow_rate, 1)
+                        if flow_rate is not None else None),
+            }
+
+
+def write_csv(rows, f):
+    writer = csv.DictWriter(f, FIELDS)
+    writer.writeheader()
+    for row in rows:
+        if row["water"] is None:
+            row["water"] = ""
+        writer.writerow(row)
+
+
+def write_json(rows, f):
+    """Write a JSON array a row at a time, rather than building it first."""
+    f.write("[")
+    separator = "\n"
+    for row in rows:
+        f.write(separator)
+        f.write(json.dumps(row, sort_keys=True))
+        separator = ",\n"
+    f.write("\n]\n")
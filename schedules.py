@@ -0,0 +1,150 @@
+import bisect
+import collections
+import datetime
+import time
+
+
+# How long after its start a scheduled run can still be made up, beyond its
+# own duration
+WINDOW_GRACE = 60*60
+
+# Recurring schedules are expanded this far ahead, and again once half of
+# that has passed
+EXPANSION_HORIZON = 2*24*60*60
+
+WEEKDAYS = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+
+# A scheduled run. start is in seconds since the epoch.
+ScheduleItem = collections.namedtuple(
+    "ScheduleItem", ["start", "duration", "min_duration", "window"])
+
+
+def to_seconds(start_time):
+    """Seconds since the epoch for a naive local datetime."""
+    return time.mktime(start_time.timetuple()) + start_time.microsecond / 1e6
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+class Recurrence(object):
+    """A recurrence rule: the daily and weekly subset of an RFC 5545 RRULE.
+
+    Supports FREQ=DAILY or FREQ=WEEKLY with optional INTERVAL, BYDAY (e.g.
+    MO,WE,FR) and UNTIL (YYYYMMDD, inclusive), plus a comma-separated list
+    of YYYY-MM-DD dates to skip.
+    """
+    def __init__(self, rule, exdates=None):
+        parts = dict(part.split("=", 1)
+                for part in rule.upper().split(";") if part)
+        self.freq = parts.get("FREQ")
+        if self.freq not in ("DAILY", "WEEKLY"):
+            raise ValueError("Unsupported recurrence: %s" % rule)
+        self.interval = int(parts.get("INTERVAL", 1))
+        if self.interval < 1:
+            raise ValueError("Unsupported recurrence: %s" % rule)
+        self.weekdays = None
+        if "BYDAY" in parts:
+            self.weekdays = set(
+                WEEKDAYS.index(day) for day in parts["BYDAY"].split(","))
+        self.until = None
+        if "UNTIL" in parts:
+            self.until = datetime.datetime.strptime(
+                parts["UNTIL"][:8], "%Y%m%d").date()
+        self.exdates = set(parse_date(date.strip())
+                for date in (exdates or "").split(",") if date.strip())
+
+    def matches(self, first, day):
+        """Whether the rule starting on date first has a run on date day."""
+        days = (day - first).days
+        if self.freq == "DAILY":
+            return (days % self.interval == 0 and (
+                self.weekdays is None or day.weekday() in self.weekdays))
+        weekdays = self.weekdays
+        if weekdays is None:
+            weekdays = set([first.weekday()])
+        # Count weeks from the Monday of the first run's week
+        weeks = (days + first.weekday()) // 7
+        return weeks % self.interval == 0 and day.weekday() in weekdays
+
+    def runs_on(self, first, day):
+        """Like matches, but also honoring UNTIL and the skipped dates."""
+        return (first <= day and
+                (self.until is None or day <= self.until) and
+                day not in self.exdates and self.matches(first, day))
+
+    def occurrences(self, start_time, after, before):
+        """Start times of the runs in [after, before), as naive datetimes.
+
+        start_time is the first run; the cost depends only on the length of
+        the range asked for, not on how far it is from the first run.
+        """
+        first = start_time.date()
+        day = max(first, after.date())
+        last = before.date()
+        if self.until is not None:
+            last = min(last, self.until)
+        while day <= last:
+            if self.runs_on(first, day):
+                occurrence = datetime.datetime.combine(day, start_time.time())
+                if after <= occurrence < before:
+                    yield occurrence
+            day += datetime.timedelta(1)
+
+
+class ScheduleIndex(object):
+    """A device's schedule, compiled for fast lookups.
+
+    Items are sorted by start time. Since no window is longer than the
+    longest item's, the items whose window contains a given time all start
+    within that distance before it, and are found with a bisect.
+
+    Recurring items are only expanded into runs around the time the index
+    is built; once expires has passed it should be rebuilt.
+    """
+    def __init__(self, schedule, now=None):
+        """schedule is a list of {start_time, duration, min_duration} with
+        optional rrule and exdates."""
+        if now is None:
+            now = time.time()
+        self.expires = None
+
+        items = []
+        for item in schedule:
+            window = item["duration"] + WINDOW_GRACE
+            if not item.get("rrule"):
+                items.append(ScheduleItem(to_seconds(item["start_time"]),
+                    item["duration"], item["min_duration"], window))
+                continue
+
+            recurrence = Recurrence(item["rrule"], item.get("exdates"))
+            for start_time in recurrence.occurrences(item["start_time"],
+                    datetime.datetime.fromtimestamp(now - window),
+                    datetime.datetime.fromtimestamp(now + EXPANSION_HORIZON)):
+                items.append(ScheduleItem(to_seconds(start_time),
+                    item["duration"], item["min_duration"], window))
+            self.expires = now + EXPANSION_HORIZON / 2
+
+        self.items = sorted(items)
+        self.starts = [item.start for item in self.items]
+        self.max_window = max([item.window for item in self.items] or [0])
+
+    def active(self, now):
+        """Items whose window contains now, earliest first."""
+        first = bisect.bisect_left(self.starts, now - self.max_window)
+        last = bisect.bisect_right(self.starts, now)
+        return [item for item in self.items[first:last]
+                if now - item.start < item.window]
+
+    def next_item(self, now):
+        """The first item starting after now, or None."""
+        index = bisect.bisect_right(self.starts, now)
+        if index < len(self.starts):
+            return self.items[index]
+        return None
+
+    def next_start(self, now):
+        """Start of the first item after now, or None."""
+        item = self.next_item(now)
+        return item.start if item else None
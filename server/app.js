@@ -1,7 +1,5 @@
 var express = require('express'),
-    _ = require('underscore'),
-    q = require('q'),
-    sqlite = require('sqlite3');
+    request = require('request');
 
 var app = express();
 
@@ -20,42 +18,15 @@ app.get('/images/sprinkler.jpg', function(req, res) {
     res.sendfile("images/sprinkler.jpg");
 });
 
-var db = new sqlite.Database("/var/lib/pi-timer/db.sqlite");
-var fetchRows = function() {
-    var deferred = q.defer();
-    params = Array.prototype.slice.call(arguments, 0);
-    params.push(function(err, rows) {
-        if (err) {
-            deferred.reject(err);
-        } else {
-            deferred.resolve(rows);
-        }
-    });
-    db.all.apply(db, params);
-    return deferred.promise;
-};
+// Dashboard data is served by the daemon (see dataservice.py)
+var DATA_SERVICE = "http://127.0.0.1:9275";
 
-app.get('/data', function(req, res) {
-    var returnData = {
-        devices: {}
-    };
-    fetchRows("SELECT device_id, group_id, type, display_name, pin FROM devices").then(function(devices) {
-            var deferreds = _.map(devices, function(device) {
-                returnData.devices[device.device_id] = device;
-                return fetchRows("SELECT timestamp, enabled FROM device_history WHERE device = ? ORDER BY timestamp", device.device_id).then(function(history) {
-                    returnData.devices[device.device_id].history = history;
-                    return fetchRows("SELECT timestamp, start_time, duration, min_duration FROM device_schedule WHERE device = ? ORDER BY timestamp", device.device_id).then(function(schedule) {
-                        returnData.devices[device.device_id].schedule = schedule;
-                    });
-                });
-            });
-            return q.all(deferreds);
-        }).then(function() {
-            res.json(returnData);
-        },
-        function(err) {
-            res.send(500, err);
-        });
+app.get(/^\/api\//, function(req, res) {
+    req.pipe(request(DATA_SERVICE + req.url))
+        .on('error', function(err) {
+            res.send(502, "pi-timer daemon unavailable: " + err.message);
+        })
+        .pipe(res);
 });
 
 app.listen(80, "::");
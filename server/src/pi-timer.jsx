@@ -6,6 +6,22 @@ var toDate = function(sec) {
     return d;
 };
 
+// How much history the page shows, in seconds
+var HISTORY_WINDOW = 24 * 60 * 60;
+// Rows to ask for per /api/history request (the most it returns)
+var HISTORY_PAGE = 5000;
+
+var getJSON = function(url, callback) {
+    var xmlhttp = new XMLHttpRequest();
+    xmlhttp.onreadystatechange = function() {
+        if (xmlhttp.readyState === 4 && xmlhttp.status === 200) {
+            callback(JSON.parse(xmlhttp.responseText));
+        }
+    };
+    xmlhttp.open("GET", url, true);
+    xmlhttp.send();
+};
+
 var PiTimerView = React.createClass({
     getInitialState: function() {
         return {
@@ -15,34 +31,86 @@ var PiTimerView = React.createClass({
         };
     },
 
+    // History rows we have, by ID, and the cursor for rows added since
+    history: {},
+    cursor: null,
+
+    addHistory: function(rows) {
+        var self = this;
+        _.each(rows, function(entry) {
+            self.history[entry.id] = entry;
+        });
+    },
+
+    fetchWindow: function(from, callback) {
+        var self = this;
+        getJSON("/api/history?limit=" + HISTORY_PAGE + "&from=" + from,
+                function(result) {
+            var rows = result.history;
+            self.addHistory(rows);
+            if (rows.length < HISTORY_PAGE) {
+                callback();
+                return;
+            }
+            // Ask again from the last timestamp; rows at it come back twice,
+            // but are kept by ID
+            var last = rows[rows.length - 1].timestamp;
+            self.fetchWindow(last > from ? last : from + 1, callback);
+        });
+    },
+
+    fetchChanges: function(callback) {
+        var self = this;
+        getJSON("/api/changes?since=" + this.cursor, function(result) {
+            self.addHistory(result.history);
+            self.cursor = result.cursor;
+            if (result.more) {
+                self.fetchChanges(callback);
+            } else {
+                callback();
+            }
+        });
+    },
+
     loadData: function() {
         var self = this;
         this.setState({
             loading: true
         });
-        var xmlhttp = new XMLHttpRequest();
-        xmlhttp.onreadystatechange = function() {
-            if (xmlhttp.readyState === 4 && xmlhttp.status === 200) {
-                var data = JSON.parse(xmlhttp.responseText);
-                // Convert timestamps to dates
+        getJSON("/api/devices", function(data) {
+            var loaded = function() {
+                // Forget rows that have left the window and hand the rest to
+                // their devices, converting timestamps to dates
+                var cutoff = data.now - HISTORY_WINDOW;
                 _.each(data.devices, function(device) {
-                    _.each(device.history, function(entry) {
-                        entry.timestamp = toDate(entry.timestamp);
-                    });
-                    _.each(device.schedule, function(entry) {
-                        entry.timestamp = toDate(entry.timestamp);
-                        entry.start_time = toDate(entry.start_time);
-                    });
+                    device.history = [];
+                });
+                _.each(_.sortBy(_.values(self.history), "id"), function(entry) {
+                    if (entry.timestamp < cutoff) {
+                        delete self.history[entry.id];
+                    } else if (data.devices[entry.device]) {
+                        data.devices[entry.device].history.push({
+                            timestamp: toDate(entry.timestamp),
+                            enabled: entry.enabled
+                        });
+                    }
                 });
                 self.setState({
                     loading: false,
                     lastFetch: new Date(),
                     data: data
                 });
+            };
+            if (self.cursor === null) {
+                // Load the whole window once, then only what changed. Rows
+                // added while it loads are past the cursor, so the next
+                // /api/changes picks them up.
+                self.cursor = data.cursor;
+                self.fetchWindow(Math.floor(data.now - HISTORY_WINDOW), loaded);
+            } else {
+                self.fetchChanges(loaded);
             }
-        }
-        xmlhttp.open("GET", "/data", true);
-        xmlhttp.send();
+        });
     },
 
     componentDidMount: function() {
@@ -108,22 +176,13 @@ var PiTimerView = React.createClass({
             return <div>Loading...</div>;
         }
 
-        var now = new Date();
-
         return <div>
             <div style={styles.updateTime}>
                 <span>Last updated: {""+this.state.lastFetch}</span>
                 {this.state.loading && <span>(Loading...)</span>}
             </div>
             {_.map(this.state.data.devices, function(device) {
-                var nextRun = null;
-                _.each(device.schedule, function(entry) {
-                    if (entry.start_time >= now) {
-                        if (!nextRun || entry.start_time < nextRun.start_time) {
-                            nextRun = entry;
-                        }
-                    }
-                });
+                var summary = device.summary || {};
                 var history = [];
                 var runStart = null;
                 _.each(device.history, function(entry) {
@@ -142,10 +201,10 @@ var PiTimerView = React.createClass({
                 history.reverse();
 
                 var nextRunView = <span>No upcoming events on calendar.</span>;
-                if (runStart !== null) {
-                    nextRunView = <span style={styles.currentlyRunning}>Device is currently running. (Started {runStart.toLocaleTimeString()})</span>;
-                } else if (nextRun) {
-                    nextRunView = <span>{nextRun.start_time.toLocaleString()} for {nextRun.duration/1000} seconds.</span>;
+                if (summary.on) {
+                    nextRunView = <span style={styles.currentlyRunning}>Device is currently running. (Started {toDate(summary.on_since).toLocaleTimeString()})</span>;
+                } else if (summary.next_run) {
+                    nextRunView = <span>{toDate(summary.next_run.start).toLocaleString()} for {summary.next_run.duration} seconds.</span>;
                 }
                 return <div style={styles.deviceCard}>
                     <div style={styles.iconWrapper}>
@@ -158,6 +217,10 @@ var PiTimerView = React.createClass({
                         <span style={styles.nextRunLabel}>Next scheduled run:</span>
                         {nextRunView}
                       </div>
+                      {device.summary && <div style={styles.nextRun}>
+                        <span style={styles.nextRunLabel}>Today:</span>
+                        <span>On for {Math.round(summary.seconds_today / 60)} minutes in {summary.runs_today} runs.</span>
+                      </div>}
                       <ul style={styles.historyList}>
                         {history}
                       </ul>
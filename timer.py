@@ -1,35 +1,152 @@
 #!/usr/bin/python
 
 import argparse
+import csv
 import datetime
 import httplib
 import json
+import sys
 import time
 
 import db
+import report
+import schedules
 import secrets
+from db import from_schedule_timestamp
 
 db = db.DB('/var/lib/pi-timer/db.sqlite', None)
 
 parser = argparse.ArgumentParser(description='Query pi-timer database')
-parser.add_argument('action', choices=['devices', 'history', 'clearhistory', 'schedule', 'clearschedule', 'authenticate', 'refreshgc'])
-parser.add_argument('device', type=int)
+parser.add_argument('action', choices=['devices', 'history', 'clearhistory', 'schedule', 'clearschedule', 'authenticate', 'refreshgc', 'report'])
+parser.add_argument('device', type=int, nargs='?')
 parser.add_argument('--setschedule', nargs=4)
+parser.add_argument('--repeat', metavar='RRULE',
+        help='repeat the --setschedule run, e.g. FREQ=WEEKLY;BYDAY=MO,TH;UNTIL=20150930')
+parser.add_argument('--except', dest='exdates', metavar='DATES',
+        help='comma-separated YYYY-MM-DD dates to skip a repeating run on')
+parser.add_argument('--import', dest='import_file', metavar='FILE',
+        help='replace the schedule (or one device\'s) with entries from a file')
+parser.add_argument('--export', dest='export_file', metavar='FILE',
+        help='write the schedule (or one device\'s) to a file')
+parser.add_argument('--format', choices=['json', 'csv'],
+        help='file format for --import/--export (default: from extension) or report (default: csv)')
 parser.add_argument('--add', nargs=5)
+parser.add_argument('--remove', type=int)
+parser.add_argument('--node',
+        help='with --add, the node whose daemon controls the device')
+parser.add_argument('--capacity', type=int, nargs=2, metavar=('GROUP', 'COUNT'),
+        help='let up to COUNT devices in GROUP run at once')
+parser.add_argument('--flow', nargs=2, metavar=('DEVICE', 'RATE'),
+        help='set how much water DEVICE uses per minute, for reports')
+parser.add_argument('--days', type=int,
+        help='summarize history per day for this many days (report: default 365)')
+parser.add_argument('--period', choices=report.PERIODS, default='day',
+        help='report totals per day or per week')
 
 args = parser.parse_args()
+# Without a device, report covers them all and --import/--export the whole
+# schedule; these actions need one
+if args.device is None and (
+        args.action in ('history', 'clearhistory', 'clearschedule') or
+        (args.action == 'schedule' and
+            not (args.import_file or args.export_file))):
+    parser.error("%s needs a device" % args.action)
+
+SCHEDULE_FIELDS = ['device', 'start_time', 'duration', 'min_duration',
+                   'rrule', 'exdates']
+SCHEDULE_TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+def schedule_format(filename):
+    if args.format:
+        return args.format
+    if filename.endswith(".csv"):
+        return "csv"
+    return "json"
+
+def check_recurrence(rrule, exdates):
+    """Raise ValueError unless the rule and exception dates can be expanded."""
+    if rrule:
+        schedules.Recurrence(rrule, exdates)
+    elif exdates:
+        raise ValueError("Exception dates need a recurrence rule")
+
+def import_schedule(filename):
+    """Read (device, start_time, duration, min_duration, rrule, exdates)
+    entries."""
+    f = sys.stdin if filename == "-" else open(filename)
+    if schedule_format(filename) == "csv":
+        reader = csv.DictReader(f)
+        entries = (("line %d" % reader.line_num, entry) for entry in reader)
+    else:
+        entries = (("entry %d" % (i + 1), entry)
+                for i, entry in enumerate(json.load(f)))
+    rows = []
+    for where, entry in entries:
+        try:
+            rrule = entry.get("rrule") or None
+            exdates = entry.get("exdates") or None
+            check_recurrence(rrule, exdates)
+            rows.append((int(entry["device"]),
+                 datetime.datetime.strptime(entry["start_time"], SCHEDULE_TIME_FORMAT),
+                 int(entry["duration"]),
+                 int(entry.get("min_duration") or 0),
+                 rrule, exdates))
+        except KeyError as e:
+            parser.error("%s %s: missing %s" % (filename, where, e))
+        except (ValueError, TypeError, AttributeError) as e:
+            parser.error("%s %s: %s" % (filename, where, e))
+    return rows
+
+def export_schedule(filename, rows):
+    entries = [{
+        "device": row[0],
+        "start_time": from_schedule_timestamp(row[1]).strftime(
+            SCHEDULE_TIME_FORMAT),
+        "duration": row[2],
+        "min_duration": row[3],
+        "rrule": row[4] or "",
+        "exdates": row[5] or ""
+    } for row in rows]
+    f = sys.stdout if filename == "-" else open(filename, "w")
+    if schedule_format(filename) == "csv":
+        writer = csv.DictWriter(f, SCHEDULE_FIELDS)
+        writer.writeheader()
+        writer.writerows(entries)
+    else:
+        json.dump(entries, f, indent=2, sort_keys=True)
+        f.write("\n")
+    if f is not sys.stdout:
+        f.close()
 
 if args.action == "devices":
     if args.add:
-        db.add_device(int(args.add[0]), int(args.add[1]), args.add[2], args.add[3], int(args.add[4]))
+        db.add_device(int(args.add[0]), int(args.add[1]), args.add[2], args.add[3], int(args.add[4]), args.node)
+    if args.remove is not None:
+        db.remove_device(args.remove)
+    if args.capacity:
+        db.set_group_capacity(args.capacity[0], args.capacity[1])
+    if args.flow:
+        db.set_flow_rate(int(args.flow[0]), float(args.flow[1]))
         
     devices = db.list_devices()
+    flow_rates = db.get_flow_rates()
     print "Devices:"
     for device in devices:
-        print "Device %d: %s (type %s; group %d; pin %d)" % (
-            device[0], device[3], device[2], device[1], device[4])
+        print "Device %d: %s (type %s; group %d; pin %d%s)" % (
+            device[0], device[3], device[2], device[1], device[4],
+            "; node %s" % device[5] if device[5] is not None else "")
+        if device[0] in flow_rates:
+            print "Uses %g per minute" % flow_rates[device[0]]
+    for (group, capacity) in sorted(db.get_group_capacities().items()):
+        print "Group %d: up to %d devices at once" % (group, capacity)
+
+if args.action == "history" and args.days:
+    now = int(time.time())
+    for row in db.get_device_daily(args.device, now - args.days*24*60*60, now):
+        print "%s: on %d seconds in %d runs" % (
+            datetime.date.fromtimestamp(row[0]), row[1], row[2])
 
-if args.action == "history":
+if args.action == "history" and not args.days:
     history = db.get_device_history(args.device, int(time.time()) - (24*60*60))
     last_on_time = None
     for row in history:
@@ -41,24 +158,49 @@ if args.action == "history":
             print "%s: Device turned OFF (%d seconds)" % (date_str, row[0] - last_on_time)
             last_on_time = None
 
+if args.action == "report":
+    now = int(time.time())
+    rows = report.build_report(db, now - (args.days or 365)*24*60*60, now,
+            args.period, args.device)
+    if args.format == "json":
+        report.write_json(rows, sys.stdout)
+    else:
+        report.write_csv(rows, sys.stdout)
+
 if args.action == "clearhistory":
     db.clear_device_history(args.device)
     print "Cleared history."
 
-if args.action == "schedule":
+if args.action == "schedule" and (args.import_file or args.export_file):
+    if args.import_file:
+        if db.replace_manual_schedules(
+                import_schedule(args.import_file), args.device):
+            print "Schedule replaced."
+        else:
+            print "Schedule unchanged."
+    if args.export_file:
+        export_schedule(args.export_file, db.get_manual_schedules(args.device))
+
+if args.action == "schedule" and not (args.import_file or args.export_file):
     if args.setschedule:
         start_time = datetime.datetime.strptime(
             "%s %s" % (args.setschedule[0], args.setschedule[1]),
             "%Y-%m-%d %H:%M")
         duration = int(args.setschedule[2])
         min_duration = int(args.setschedule[3])
-        db.set_device_schedule(args.device, start_time, duration, min_duration)
+        check_recurrence(args.repeat, args.exdates)
+        db.set_device_schedule(args.device, start_time, duration, min_duration,
+                args.repeat, args.exdates)
     schedule = db.get_device_schedule(args.device)
     if schedule:
         print "Device schedule:"
         for row in schedule:
             print "Run at %s for up to %d seconds (min %d seconds)" % (
                     datetime.datetime.fromtimestamp(row[1]), row[2], row[3])
+            if row[4]:
+                print "Repeats %s" % row[4]
+            if row[5]:
+                print "Except on %s" % row[5]
             print "Set on %s" % datetime.datetime.fromtimestamp(row[0])
     else:
         print "No schedule set for %d" % args.device
@@ -83,5 +225,6 @@ if args.action == "authenticate":
 
 if args.action == "refreshgc":
     db.set_global("gcupdatetime", "0")
-    print "gcupdatetime global reset."
+    db.set_global("gcsynctoken", "")
+    print "gcupdatetime global reset; the next sync will be a full sync."
 